@@ -1,12 +1,93 @@
 import json
 import boto3
+import concurrent.futures
 import os
+import threading
+import time
+from botocore.config import Config
+from collections import OrderedDict
 from datetime import datetime
 
-sqs = boto3.client('sqs', region_name='us-east-1')
+# Fulfillment's SQS send and last-search save run side by side; Lex gets its
+# reply once both finish or this many seconds pass, whichever is first
+SIDE_EFFECT_TIMEOUT_SECONDS = float(os.environ.get('SIDE_EFFECT_TIMEOUT_SECONDS', '2.5'))
+# One attempt whose connect and read timeouts add up to the deadline, so a call
+# Lex stopped waiting for gives up rather than landing after the user was told
+# to try again (botocore's defaults are 60s each, with retries)
+client_config = Config(
+    connect_timeout=SIDE_EFFECT_TIMEOUT_SECONDS / 2,
+    read_timeout=SIDE_EFFECT_TIMEOUT_SECONDS / 2,
+    retries={'total_max_attempts': 1}
+)
+sqs = boto3.client('sqs', region_name='us-east-1', config=client_config)
 SQS_QUEUE_URL = os.environ.get('SQS_QUEUE_URL', 'YOUR_SQS_QUEUE_URL')
-dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+dynamodb = boto3.resource('dynamodb', region_name='us-east-1', config=client_config)
 table = dynamodb.Table('user-last-search')
+# Session attribute carrying a returning user's last search between turns.
+# Lex only keeps attribute values that are strings, so it holds a compact JSON
+# list: [version, email, location, cuisine, diningTime, numberOfPeople].
+LAST_SEARCH_ATTR = 'lastSearch'
+LAST_SEARCH_VERSION = 1
+LAST_SEARCH_FIELDS = ['location', 'cuisine', 'diningTime', 'numberOfPeople']
+# Locations we serve: Manhattan itself, or one of the neighborhoods LF2's
+# SEARCH_MODE=nearby knows the centroid of (keep in sync with
+# NEIGHBORHOOD_CENTROIDS in LF2)
+MANHATTAN_NAMES = ['manhattan', 'new york', 'nyc', 'ny']
+NEIGHBORHOODS = [
+    'midtown', 'upper east side', 'upper west side', 'harlem', 'chelsea',
+    'greenwich village', 'east village', 'soho', 'tribeca', 'lower east side',
+    'chinatown', 'financial district'
+]
+# Warm-container copy of user-last-search; 0 for either disables it
+LAST_SEARCH_CACHE_TTL_SECONDS = float(os.environ.get('LAST_SEARCH_CACHE_TTL_SECONDS', '300'))
+LAST_SEARCH_CACHE_SIZE = int(os.environ.get('LAST_SEARCH_CACHE_SIZE', '1000'))
+
+
+class LastSearchCache:
+    # Email -> user-last-search item, filled by reads and by save_last_search
+    # once its put_item succeeds. Keyed by the email exactly as the table is,
+    # so a hit is always an item get_item would have returned. Entries expire after the
+    # TTL (other containers may have saved a newer search meanwhile) and the
+    # least recently used one is evicted when full. Misses aren't cached, so
+    # DynamoDB always has the final say on whether a user has a last search.
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, email):
+        with self.lock:
+            entry = self.entries.get(email)
+            if entry and time.monotonic() - entry[0] < self.ttl:
+                self.entries.move_to_end(email)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self.entries[email]
+            self.misses += 1
+            return None
+    
+    def put(self, email, item):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[email] = (time.monotonic(), item)
+            self.entries.move_to_end(email)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+    
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self.entries)}
+
+
+# Kept across warm invocations so threads aren't started on every request
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+last_search_cache = LastSearchCache(LAST_SEARCH_CACHE_SIZE, LAST_SEARCH_CACHE_TTL_SECONDS)
 
 def lambda_handler(event, context):
     print("LF1 Event:", json.dumps(event))
@@ -45,8 +126,8 @@ def handle_dining_suggestions(event, invocation_source):
     num_people = get_slot(slots, 'NumberOfPeople')
     email = get_slot(slots, 'Email')
     
-    # Validate location — for now only support Manhattan
-    if location and location.lower() not in ['manhattan', 'new york', 'nyc', 'ny']:
+    # Validate location — Manhattan or one of its neighborhoods
+    if location and ' '.join(location.lower().split()) not in MANHATTAN_NAMES + NEIGHBORHOODS:
         return elicit_slot(
             event,
             'Location',
@@ -56,8 +137,17 @@ def handle_dining_suggestions(event, invocation_source):
     # If all slots filled, push to SQS
     if invocation_source == 'FulfillmentCodeHook':
         if all([location, cuisine, dining_time, num_people, email]):
-            push_to_sqs(location, cuisine, dining_time, num_people, email)
-            save_last_search(email, location, cuisine, dining_time, num_people)
+            failed = run_side_effects({
+                'sqs': lambda: push_to_sqs(location, cuisine, dining_time, num_people, email),
+                'lastSearch': lambda: save_last_search(email, location, cuisine, dining_time, num_people)
+            })
+            # A missing last search only costs the returning-user shortcut;
+            # without the SQS message no email is coming
+            if 'sqs' in failed:
+                return close(event,
+                    "Sorry, I couldn't confirm your request went through. "
+                    "If no email arrives in a few minutes, please try again."
+                )
             return close(
                 event,
                 f"You're all set! Expect restaurant suggestions for {cuisine} cuisine at {dining_time} for {num_people} people. "
@@ -78,17 +168,19 @@ def handle_returning_user(event, invocation_source):
     # Step 2 — Email provided, check DynamoDB
     if email and not confirm:
         try:
-            result = table.get_item(Key={'Email': email})
+            last = load_last_search(email)
             
-            if 'Item' in result:
-                last = result['Item']
+            if last:
                 # Store last search in session for later use
+                attributes = dict(session_attributes(event))
+                attributes[LAST_SEARCH_ATTR] = encode_last_search(email, last)
                 return elicit_slot(
                     event,
                     'ConfirmSuggestion',
                     f"Welcome back! Last time you searched for {last['cuisine']} "
                     f"restaurants in {last['location']} for {last['numberOfPeople']} people. "
-                    f"Want similar suggestions again?"
+                    f"Want similar suggestions again?",
+                    attributes
                 )
             else:
                 return close(event,
@@ -103,9 +195,11 @@ def handle_returning_user(event, invocation_source):
     if confirm:
         if confirm.lower() in ['yes', 'yeah', 'sure', 'yep', 'ok', 'okay']:
             try:
-                result = table.get_item(Key={'Email': email})
-                if 'Item' in result:
-                    last = result['Item']
+                # Read in step 2 and carried in the session; DynamoDB only if it's missing
+                last = decode_last_search(session_attributes(event), email)
+                if last is None:
+                    last = load_last_search(email)
+                if last:
                     push_to_sqs(
                         last['location'],
                         last['cuisine'],
@@ -128,19 +222,69 @@ def handle_returning_user(event, invocation_source):
     
     return delegate(event)
 
-def save_last_search(email, location, cuisine, dining_time, num_people):
+def normalize_email(email):
+    return email.strip().lower()
+
+def load_last_search(email):
+    # The warm cache first, then DynamoDB; None if the user has no last search
+    last = last_search_cache.get(email)
+    if last is None:
+        last = table.get_item(Key={'Email': email}).get('Item')
+        if last:
+            last_search_cache.put(email, last)
+    print(f"Last-search cache: {last_search_cache.stats()}")
+    return last
+
+def encode_last_search(email, last):
+    return json.dumps(
+        [LAST_SEARCH_VERSION, normalize_email(email)] + [last[field] for field in LAST_SEARCH_FIELDS],
+        separators=(',', ':'), default=str
+    )
+
+def decode_last_search(attributes, email):
+    # None when absent, from another encoding version, unreadable, or saved
+    # for a different email than the one in this turn's slot
     try:
-        table.put_item(Item={
-            'Email': email,
-            'location': location,
-            'cuisine': cuisine,
-            'diningTime': dining_time,
-            'numberOfPeople': num_people,
-            'timestamp': datetime.now().isoformat()
-        })
-        print(f"Saved last search for {email}")
-    except Exception as e:
-        print(f"Error saving last search: {e}")
+        version, saved_email, *values = json.loads(attributes[LAST_SEARCH_ATTR])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if version != LAST_SEARCH_VERSION or saved_email != normalize_email(email) or len(values) != len(LAST_SEARCH_FIELDS):
+        return None
+    return dict(zip(LAST_SEARCH_FIELDS, values))
+
+def run_side_effects(effects, timeout=None):
+    # Runs {name: callable} concurrently and waits at most `timeout` seconds.
+    # Returns the names that raised or hadn't finished; those still running are
+    # left to complete in the background (or on the container's next thaw).
+    timeout = SIDE_EFFECT_TIMEOUT_SECONDS if timeout is None else timeout
+    start = time.monotonic()
+    futures = {executor.submit(effect): name for name, effect in effects.items()}
+    done, pending = concurrent.futures.wait(futures, timeout=timeout)
+    
+    failed = set()
+    for future in done:
+        if future.exception() is not None:
+            print(f"Error in {futures[future]}: {future.exception()}")
+            failed.add(futures[future])
+    for future in pending:
+        print(f"{futures[future]} still running after {timeout}s, replying without it")
+        failed.add(futures[future])
+    print(f"Side effects took {(time.monotonic() - start) * 1000:.0f} ms, failed: {sorted(failed)}")
+    return failed
+
+def save_last_search(email, location, cuisine, dining_time, num_people):
+    item = {
+        'Email': email,
+        'location': location,
+        'cuisine': cuisine,
+        'diningTime': dining_time,
+        'numberOfPeople': num_people,
+        'timestamp': datetime.now().isoformat()
+    }
+    table.put_item(Item=item)
+    # Write-through, only once DynamoDB has it
+    last_search_cache.put(email, item)
+    print(f"Saved last search for {email}")
 
 
 def push_to_sqs(location, cuisine, dining_time, num_people, email):
@@ -159,16 +303,22 @@ def push_to_sqs(location, cuisine, dining_time, num_people, email):
     print(f"Pushed to SQS: {message}")
 
 
+def session_attributes(event):
+    return event['sessionState'].get('sessionAttributes') or {}
+
 def get_slot(slots, slot_name):
     slot = slots.get(slot_name)
     if slot and slot.get('value') and slot['value'].get('interpretedValue'):
         return slot['value']['interpretedValue']
     return None
 
-# Informs Amazon Lex not to expect a response from the user
-def close(event, message):
+# Informs Amazon Lex not to expect a response from the user.
+# Like the other responses, it hands the session attributes back (the event's
+# own unless given), since Lex drops any the response leaves out.
+def close(event, message, attributes=None):
     return {
         'sessionState': {
+            'sessionAttributes': session_attributes(event) if attributes is None else attributes,
             'dialogAction': {'type': 'Close'},
             'intent': {
                 'name': event['sessionState']['intent']['name'],
@@ -192,9 +342,10 @@ def elicit_slot(event, slot_to_elicit, message):
         'messages': [{'contentType': 'PlainText', 'content': message}]
     }
 '''
-def elicit_slot(event, slot_to_elicit, message):
+def elicit_slot(event, slot_to_elicit, message, attributes=None):
     return {
         'sessionState': {
+            'sessionAttributes': session_attributes(event) if attributes is None else attributes,
             'dialogAction': {
                 'type': 'ElicitSlot',
                 'slotToElicit': slot_to_elicit
@@ -218,9 +369,10 @@ def delegate(event):
         }
     }
 '''
-def delegate(event):
+def delegate(event, attributes=None):
     return {
         'sessionState': {
+            'sessionAttributes': session_attributes(event) if attributes is None else attributes,
             'dialogAction': {'type': 'Delegate'},
             'intent': {
                 'name': event['sessionState']['intent']['name'],
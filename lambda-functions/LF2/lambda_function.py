@@ -1,38 +1,305 @@
 '''
-This lambda function is triggered by an SQS message. It reads the message from the queue,
-searches for restaurants in OpenSearch by cuisine, picks 3 random restaurants,
-fetches details from DynamoDB, and sends an email to the user with the restaurant suggestions.
+This lambda function is triggered by an SQS message. It reads the messages in the batch,
+searches OpenSearch once per distinct cuisine (_msearch), picks 3 random restaurants per message,
+fetches details for the whole batch from DynamoDB, and sends an email to the user with the
+restaurant suggestions. Failed messages are reported as batchItemFailures so only they are redelivered.
 '''
 
+import base64
 import json
 import boto3
+import concurrent.futures
 import os
 import random
+import threading
+import time
+from collections import OrderedDict
 import requests
-from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+import metrics
 
 sqs = boto3.client('sqs', region_name='us-east-1')
 dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-ses = boto3.client('ses', region_name='us-east-1')
 
 SQS_QUEUE_URL = os.environ.get('SQS_QUEUE_URL', 'YOUR_SQS_QUEUE_URL')
 OPENSEARCH_ENDPOINT = os.environ.get('OPENSEARCH_ENDPOINT', 'https://YOUR_DOMAIN.es.amazonaws.com')
 OPENSEARCH_USER = os.environ.get('OPENSEARCH_USER', 'master')
 OPENSEARCH_PASS = os.environ.get('OPENSEARCH_PASS', 'password')
 SENDER_EMAIL = os.environ.get('SENDER_EMAIL', 'your-verified@email.com')
+# 'true' for scheduled invocations that poll SQS; otherwise LF2 consumes the
+# records delivered by the SQS event source mapping.
+POLL_MODE = os.environ.get('POLL_MODE', 'false').lower() == 'true'
+# When set, emails go out through this SES template with SendBulkTemplatedEmail
+SES_TEMPLATE_NAME = os.environ.get('SES_TEMPLATE_NAME', '')
+SES_BACKEND = os.environ.get('SES_BACKEND', 'aws').lower()
+# Search and hydrate run once per batch; the per-message sends go out on up
+# to this many threads
+MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', '4'))
+TIME_MARGIN_SECONDS = float(os.environ.get('TIME_MARGIN_SECONDS', '2'))
+OPENSEARCH_POOL_SIZE = int(os.environ.get('OPENSEARCH_POOL_SIZE', os.environ.get('MAX_CONCURRENCY', '4')))
+OPENSEARCH_CONNECT_TIMEOUT = float(os.environ.get('OPENSEARCH_CONNECT_TIMEOUT', '2'))
+OPENSEARCH_READ_TIMEOUT = float(os.environ.get('OPENSEARCH_READ_TIMEOUT', '5'))
+# 'candidates' fetches up to 50 ids per cuisine (cached) and samples them here;
+# 'random' has OpenSearch return exactly PICK_COUNT ids sampled server-side;
+# 'rated' ranks by rating and review count; 'nearby' does the same within
+# NEARBY_RADIUS_KM of the requested neighborhood.
+SEARCH_MODE = os.environ.get('SEARCH_MODE', 'candidates').lower()
+NEARBY_RADIUS_KM = float(os.environ.get('NEARBY_RADIUS_KM', '2'))
+# 'true' once load_opensearch.py indexes Name/Address next to the ids, so the
+# email can be built from search hits alone.
+INDEX_DISPLAY_FIELDS = os.environ.get('INDEX_DISPLAY_FIELDS', 'false').lower() == 'true'
+# Candidate lists only change when load_opensearch.py reloads the index
+CACHE_TTL_SECONDS = float(os.environ.get('CACHE_TTL_SECONDS', '300'))
+CACHE_MAX_CUISINES = int(os.environ.get('CACHE_MAX_CUISINES', '64'))
+CACHE_GENERATION_CHECK_SECONDS = float(os.environ.get('CACHE_GENERATION_CHECK_SECONDS', '60'))
 
-table = dynamodb.Table('yelp-restaurants')
+# An alias when the index is built with load_opensearch.py --reindex
+INDEX = 'restaurants'
+PICK_COUNT = 3
+EMAIL_FIELDS = ['Name', 'Address']
+DISPLAY_FIELDS = ['Name', 'Address', 'Rating', 'NumberOfReviews', 'ZipCode']
+SOURCE_FIELDS = ['RestaurantID'] + (DISPLAY_FIELDS if INDEX_DISPLAY_FIELDS else [])
+# Approximate centroids (lat, lon) for the 'nearby' search mode. Anything else
+# (e.g. just 'Manhattan') is searched borough-wide without a distance filter.
+NEIGHBORHOOD_CENTROIDS = {
+    'midtown': (40.7549, -73.9840),
+    'upper east side': (40.7736, -73.9566),
+    'upper west side': (40.7870, -73.9754),
+    'harlem': (40.8116, -73.9465),
+    'chelsea': (40.7465, -74.0014),
+    'greenwich village': (40.7336, -74.0027),
+    'east village': (40.7265, -73.9815),
+    'soho': (40.7233, -74.0030),
+    'tribeca': (40.7163, -74.0086),
+    'lower east side': (40.7150, -73.9843),
+    'chinatown': (40.7158, -73.9970),
+    'financial district': (40.7075, -74.0113)
+}
+RESTAURANTS_TABLE = 'yelp-restaurants'
+BATCH_GET_LIMIT = 100
+BATCH_GET_MAX_RETRIES = 5
+SES_BULK_LIMIT = 50
+DEFAULT_TEMPLATE_DATA = {'cuisine': '', 'numPeople': '', 'diningTime': '', 'restaurants': []}
+
+
+class OpenSearchClient:
+    # Lives at module level so warm invocations reuse the pooled keep-alive
+    # connections instead of paying a TCP + TLS handshake per request.
+    def __init__(self, endpoint, user, password, pool_size, connect_timeout, read_timeout):
+        self.endpoint = endpoint.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        
+        token = base64.b64encode(f"{user}:{password}".encode()).decode()
+        self.session.headers.update({
+            'Authorization': f'Basic {token}',
+            'Connection': 'keep-alive'
+        })
+        # Totals at the previous connection_stats() call
+        self.last_totals = (0, 0)
+    
+    def get(self, path):
+        r = self.session.get(f"{self.endpoint}{path}", timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()
+    
+    def post(self, path, data, content_type='application/json'):
+        r = self.session.post(
+            f"{self.endpoint}{path}",
+            data=data,
+            headers={'Content-Type': content_type},
+            timeout=self.timeout
+        )
+        r.raise_for_status()
+        return r.json()
+    
+    def connection_stats(self):
+        # urllib3 counts every request and every newly opened connection per
+        # pool; whatever isn't a new connection went over a reused one. Those
+        # counters live as long as the container, so this returns what changed
+        # since the last call, i.e. during the current invocation.
+        opened = sent = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:
+                continue
+            opened += pool.num_connections
+            sent += pool.num_requests
+        
+        last_opened, last_sent = self.last_totals
+        if opened < last_opened or sent < last_sent:
+            # The pool was replaced, so its counters started over
+            last_opened = last_sent = 0
+        self.last_totals = (opened, sent)
+        opened -= last_opened
+        sent -= last_sent
+        return {'opened': opened, 'reused': max(sent - opened, 0)}
+
+
+class CandidateCache:
+    # cuisine -> candidate restaurant docs, kept across warm invocations.
+    # Entries expire after the TTL, the least recently used cuisine is evicted
+    # when full, and everything is dropped when the index generation changes.
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = None
+        self.checked_at = None
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, cuisine):
+        with self.lock:
+            entry = self.entries.get(cuisine)
+            if entry and time.monotonic() - entry[0] < self.ttl:
+                self.entries.move_to_end(cuisine)
+                self.hits += 1
+                metrics.incr('CacheHits')
+                return entry[1]
+            if entry:
+                del self.entries[cuisine]
+            self.misses += 1
+            metrics.incr('CacheMisses')
+            return None
+    
+    def put(self, cuisine, docs):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[cuisine] = (time.monotonic(), docs)
+            self.entries.move_to_end(cuisine)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+    
+    def flush(self):
+        with self.lock:
+            self.entries.clear()
+    
+    def set_generation(self, generation):
+        with self.lock:
+            self.checked_at = time.monotonic()
+            if generation != self.generation:
+                if self.generation is not None:
+                    print(f"Index generation changed to {generation}, flushing candidate cache")
+                self.entries.clear()
+                self.generation = generation
+    
+    def generation_due(self):
+        return self.checked_at is None or time.monotonic() - self.checked_at >= CACHE_GENERATION_CHECK_SECONDS
+    
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+class LocalSES:
+    # Stand-in for the SES client (SES_BACKEND=local): keeps every request in
+    # outbox instead of sending, and reports every destination as delivered.
+    def __init__(self):
+        self.outbox = []
+    
+    def send_email(self, **kwargs):
+        self.outbox.append(('send_email', kwargs))
+        return {'MessageId': f'local-{len(self.outbox)}'}
+    
+    def send_bulk_templated_email(self, **kwargs):
+        self.outbox.append(('send_bulk_templated_email', kwargs))
+        return {'Status': [
+            {'Status': 'Success', 'MessageId': f'local-{len(self.outbox)}-{i}'}
+            for i in range(len(kwargs['Destinations']))
+        ]}
+
+
+if SES_BACKEND == 'local':
+    ses = LocalSES()
+else:
+    ses = boto3.client('ses', region_name='us-east-1')
+
+# Shared by warm invocations; boto3 clients and the pooled session are thread-safe
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(MAX_CONCURRENCY, 1))
+
+candidate_cache = CandidateCache(CACHE_MAX_CUISINES, CACHE_TTL_SECONDS)
+
+opensearch = OpenSearchClient(
+    OPENSEARCH_ENDPOINT, OPENSEARCH_USER, OPENSEARCH_PASS,
+    OPENSEARCH_POOL_SIZE, OPENSEARCH_CONNECT_TIMEOUT, OPENSEARCH_READ_TIMEOUT
+)
 
 
 def lambda_handler(event, context):
     print("LF2 triggered")
     
-    # Pull message from SQS
-    response = sqs.receive_message(
-        QueueUrl=SQS_QUEUE_URL,
-        MaxNumberOfMessages=1,
-        WaitTimeSeconds=5
+    # Manual flush after the index was reloaded out of band
+    if event.get('flushCache'):
+        candidate_cache.flush()
+        print("Candidate cache flushed")
+        return {'statusCode': 200, 'body': 'Cache flushed'}
+    
+    with metrics.timer('Invocation'):
+        # Scheduled invocations pull from the queue themselves
+        if POLL_MODE:
+            result = poll_queue(pipeline_deadline(context))
+        else:
+            result = process_records(event.get('Records', []), pipeline_deadline(context))
+    
+    connections = opensearch.connection_stats()
+    print(f"OpenSearch connections: {connections}")
+    print(f"Candidate cache: {candidate_cache.stats()}")
+    metrics.flush(
+        SearchMode=SEARCH_MODE,
+        OpenSearchConnectionsOpened=connections['opened'],
+        OpenSearchConnectionsReused=connections['reused']
     )
+    return result
+
+
+def pipeline_deadline(context):
+    # Stop starting new stages TIME_MARGIN_SECONDS before Lambda times out, so
+    # unfinished messages are reported as failures instead of being lost.
+    if context is None:
+        return None
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000 - TIME_MARGIN_SECONDS
+
+
+def out_of_time(deadline):
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def process_records(records, deadline=None):
+    # Invoked by the SQS event source mapping. Successful messages are deleted
+    # by Lambda; only the failed ones are reported back for redelivery.
+    print(f"Received {len(records)} records")
+    metrics.incr('BatchSize', len(records))
+    jobs = []
+    failed = []
+    
+    for record in records:
+        try:
+            jobs.append((record['messageId'], json.loads(record['body'])))
+        except ValueError as e:
+            print(f"Error parsing message {record['messageId']}: {e}")
+            failed.append(record['messageId'])
+    
+    failed.extend(process_batch(jobs, deadline))
+    metrics.incr('FailedMessages', len(failed))
+    return {'batchItemFailures': [{'itemIdentifier': mid} for mid in failed]}
+
+
+def poll_queue(deadline=None):
+    # Pull message from SQS
+    with metrics.timer('SqsReceive'):
+        response = sqs.receive_message(
+            QueueUrl=SQS_QUEUE_URL,
+            MaxNumberOfMessages=1,
+            WaitTimeSeconds=5
+        )
     
     messages = response.get('Messages', [])
     if not messages:
@@ -40,60 +307,340 @@ def lambda_handler(event, context):
         return {'statusCode': 200, 'body': 'No messages'}
     
     message = messages[0]
-    receipt_handle = message['ReceiptHandle']
-    body = json.loads(message['Body'])
+    metrics.incr('BatchSize')
+    failed = process_batch([(message['MessageId'], json.loads(message['Body']))], deadline)
+    if failed:
+        metrics.incr('FailedMessages', len(failed))
+        return {'statusCode': 500, 'body': 'Processing failed'}
     
-    print(f"Processing: {body}")
+    # Delete message from queue
+    with metrics.timer('SqsDelete'):
+        sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=message['ReceiptHandle'])
     
-    cuisine = body.get('cuisine', 'Italian')
-    email = body.get('email')
-    dining_time = body.get('diningTime', '')
-    num_people = body.get('numberOfPeople', '2')
+    return {'statusCode': 200, 'body': 'Processed successfully'}
+
+
+def process_batch(jobs, deadline=None):
+    # jobs is a list of (message_id, body) pairs; returns the ids that failed.
+    failed = []
+    parsed = []
     
-    # Search OpenSearch for restaurants by cuisine
-    restaurant_ids = search_opensearch(cuisine)
+    for message_id, body in jobs:
+        try:
+            parsed.append((message_id, parse_request(body)))
+        except Exception as e:
+            print(f"Error processing message {message_id}: {e}")
+            failed.append(message_id)
     
-    if not restaurant_ids:
-        print(f"No restaurants found for cuisine: {cuisine}")
-        sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=receipt_handle)
-        return {'statusCode': 200, 'body': 'No restaurants found'}
+    if out_of_time(deadline):
+        return failed + [message_id for message_id, _ in parsed]
     
-    # Pick 3 random restaurants
-    picked_ids = random.sample(restaurant_ids, min(3, len(restaurant_ids)))
+    # One _msearch covers the whole batch
+    try:
+        with metrics.timer('Search'):
+            picks = pick_restaurants(parsed)
+    except Exception as e:
+        print(f"Error searching OpenSearch: {e}")
+        return failed + [message_id for message_id, _ in parsed]
     
-    # Fetch details from DynamoDB
-    restaurants = []
-    for rid in picked_ids:
-        resp = table.get_item(Key={'BusinessID': rid})
-        if 'Item' in resp:
-            restaurants.append(resp['Item'])
+    pending = []
+    for message_id, request in parsed:
+        if message_id not in picks:
+            failed.append(message_id)
+            continue
+        
+        if not picks[message_id]:
+            print(f"No restaurants found for cuisine: {request['cuisine']}")
+            continue
+        
+        request['picks'] = picks[message_id]
+        pending.append((message_id, request))
     
-    # Send email
-    if restaurants and email:
-        send_email(email, cuisine, dining_time, num_people, restaurants)
+    if out_of_time(deadline):
+        return failed + [message_id for message_id, _ in pending]
     
-    # Delete message from queue
-    sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=receipt_handle)
+    # Fetch missing details for every restaurant picked across the batch at once
+    try:
+        with metrics.timer('Hydrate'):
+            hydrate_restaurants(pending)
+    except Exception as e:
+        print(f"Error fetching restaurant details: {e}")
+        return failed + [message_id for message_id, _ in pending]
     
-    return {'statusCode': 200, 'body': 'Processed successfully'}
+    if out_of_time(deadline):
+        return failed + [message_id for message_id, _ in pending]
+    
+    with metrics.timer('Send'):
+        failed.extend(send_suggestions(pending, deadline))
+    return failed
+
+
+def parse_request(body):
+    print(f"Processing: {body}")
+    
+    return {
+        'cuisine': normalize_cuisine(body.get('cuisine') or 'Italian'),
+        'email': body.get('email'),
+        'dining_time': body.get('diningTime', ''),
+        'num_people': body.get('numberOfPeople', '2'),
+        'location': body.get('location', '')
+    }
 
 
-def search_opensearch(cuisine):
-    url = f"{OPENSEARCH_ENDPOINT}/restaurants/_search"
-    query = {
-        "query": {
-            "match": {"Cuisine": cuisine}
-        },
-        "size": 50
+def normalize_cuisine(cuisine):
+    # Cuisine is indexed as a keyword exactly as the scraper saved it ('Japanese')
+    return ' '.join(cuisine.split()).title()
+
+
+def pick_restaurants(parsed):
+    # Returns {message_id: picked docs}; messages left out failed their search.
+    if SEARCH_MODE in ('random', 'rated', 'nearby'):
+        return sample_opensearch(parsed)
+    
+    candidates = search_opensearch({req['cuisine'] for _, req in parsed})
+    picks = {}
+    for message_id, request in parsed:
+        if request['cuisine'] in candidates:
+            docs = candidates[request['cuisine']]
+            # Pick 3 random restaurants; copies, since the cached docs are shared
+            picks[message_id] = [dict(doc) for doc in random.sample(docs, min(PICK_COUNT, len(docs)))]
+    return picks
+
+
+def hydrate_restaurants(pending):
+    # Search hits carry the email fields when the index was loaded with display
+    # fields; DynamoDB is only read for the picks still missing some of them.
+    missing = {
+        doc['RestaurantID']
+        for _, request in pending
+        for doc in request['picks']
+        if not all(doc.get(field) for field in EMAIL_FIELDS)
     }
+    if not missing:
+        return
     
-    r = requests.get(
-        url, json=query,
-        auth=HTTPBasicAuth(OPENSEARCH_USER, OPENSEARCH_PASS)
-    )
+    restaurants = fetch_restaurants(missing)
+    for _, request in pending:
+        for doc in request['picks']:
+            for field in EMAIL_FIELDS:
+                if not doc.get(field) and field in restaurants.get(doc['RestaurantID'], {}):
+                    doc[field] = restaurants[doc['RestaurantID']][field]
+
+
+def send_suggestions(pending, deadline=None):
+    # Returns the message ids whose email could not be sent. Each email (or
+    # bulk chunk of SES_BULK_LIMIT) is its own SES call, so those are what
+    # goes out concurrently.
+    ready = []
+    for message_id, request in pending:
+        # Restaurants found in neither OpenSearch nor DynamoDB are left out
+        picked = [doc for doc in request['picks'] if doc.get('Name')]
+        if picked and request['email']:
+            ready.append((message_id, request, picked))
+    
+    if SES_TEMPLATE_NAME:
+        tasks = [
+            (send_bulk_emails, ready[start:start + SES_BULK_LIMIT])
+            for start in range(0, len(ready), SES_BULK_LIMIT)
+        ]
+    else:
+        tasks = [(send_plain_emails, [entry]) for entry in ready]
+    return run_concurrently(tasks, deadline)
+
+
+def run_concurrently(tasks, deadline=None):
+    # tasks are (function, entries) pairs, where function(entries) returns the
+    # failed message ids. Runs them on the executor until the deadline; a task
+    # that raised or is still running counts all of its messages as failed.
+    if len(tasks) <= 1 or MAX_CONCURRENCY <= 1:
+        failed = []
+        for function, entries in tasks:
+            failed.extend(function(entries))
+        return failed
+    
+    futures = {executor.submit(function, entries): entries for function, entries in tasks}
+    timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+    done, not_done = concurrent.futures.wait(futures, timeout=timeout)
     
-    hits = r.json().get('hits', {}).get('hits', [])
-    return [hit['_source']['RestaurantID'] for hit in hits]
+    failed = []
+    for future in done:
+        try:
+            failed.extend(future.result())
+        except Exception as e:
+            print(f"Error sending suggestions: {e}")
+            failed.extend(message_id for message_id, _, _ in futures[future])
+    for future in not_done:
+        print(f"{len(futures[future])} emails not sent in time")
+        failed.extend(message_id for message_id, _, _ in futures[future])
+    return failed
+
+
+def send_plain_emails(entries):
+    failed = []
+    for message_id, request, picked in entries:
+        try:
+            send_email(request['email'], request['cuisine'], request['dining_time'],
+                       request['num_people'], picked)
+        except Exception as e:
+            print(f"Error sending suggestions for message {message_id}: {e}")
+            failed.append(message_id)
+    return failed
+
+
+def fetch_restaurants(restaurant_ids):
+    # One BatchGetItem per 100 distinct ids instead of a get_item per pick.
+    restaurant_ids = list(restaurant_ids)
+    restaurants = {}
+    
+    for start in range(0, len(restaurant_ids), BATCH_GET_LIMIT):
+        request = {
+            RESTAURANTS_TABLE: {
+                'Keys': [{'BusinessID': rid} for rid in restaurant_ids[start:start + BATCH_GET_LIMIT]],
+                'ProjectionExpression': 'BusinessID, #name, #address',
+                'ExpressionAttributeNames': {'#name': 'Name', '#address': 'Address'}
+            }
+        }
+        attempt = 0
+        while request:
+            resp = dynamodb.meta.client.batch_get_item(RequestItems=request)
+            for item in resp.get('Responses', {}).get(RESTAURANTS_TABLE, []):
+                restaurants[item['BusinessID']] = item
+            
+            # Throttled keys come back unprocessed; retry them with backoff
+            request = resp.get('UnprocessedKeys')
+            if request:
+                attempt += 1
+                metrics.incr('BatchGetRetries')
+                if attempt > BATCH_GET_MAX_RETRIES:
+                    raise RuntimeError(f"Unprocessed keys after {attempt - 1} retries")
+                time.sleep(random.uniform(0, min(2.0, 0.05 * 2 ** attempt)))
+    
+    metrics.incr('RestaurantsFetched', len(restaurants))
+    print(f"Fetched {len(restaurants)} of {len(restaurant_ids)} restaurants")
+    return restaurants
+
+
+def search_opensearch(cuisines):
+    # Returns {cuisine: [restaurant docs]}; cuisines whose sub-search failed are
+    # left out so their messages can be retried.
+    check_index_generation()
+    
+    results = {}
+    missing = []
+    for cuisine in sorted(cuisines):
+        docs = candidate_cache.get(cuisine)
+        if docs is None:
+            missing.append(cuisine)
+        else:
+            results[cuisine] = docs
+    
+    # Only cache misses go to OpenSearch
+    if not missing:
+        return results
+    
+    lines = []
+    for cuisine in missing:
+        lines.append(json.dumps({"index": INDEX}))
+        lines.append(json.dumps({
+            "query": {
+                "match": {"Cuisine": cuisine}
+            },
+            "size": 50,
+            "_source": SOURCE_FIELDS
+        }))
+    
+    with metrics.timer('OpenSearch'):
+        data = opensearch.post('/_msearch', '\n'.join(lines) + '\n', 'application/x-ndjson')
+    
+    for cuisine, response in zip(missing, data.get('responses', [])):
+        if 'error' in response:
+            print(f"Search failed for {cuisine}: {response['error']}")
+            continue
+        hits = response.get('hits', {}).get('hits', [])
+        results[cuisine] = [hit['_source'] for hit in hits]
+        candidate_cache.put(cuisine, results[cuisine])
+    
+    return results
+
+
+def sample_opensearch(parsed):
+    # Lets OpenSearch pick: each message gets a query returning exactly
+    # PICK_COUNT hits, and only their _source fields come back.
+    if not parsed:
+        return {}
+    
+    lines = []
+    for _, request in parsed:
+        lines.append(json.dumps({"index": INDEX}))
+        lines.append(json.dumps({
+            "query": ranked_query(request),
+            "size": PICK_COUNT,
+            "_source": SOURCE_FIELDS
+        }))
+    
+    with metrics.timer('OpenSearch'):
+        data = opensearch.post('/_msearch', '\n'.join(lines) + '\n', 'application/x-ndjson')
+    
+    picks = {}
+    for (message_id, request), response in zip(parsed, data.get('responses', [])):
+        if 'error' in response:
+            print(f"Search failed for {request['cuisine']}: {response['error']}")
+            continue
+        hits = response.get('hits', {}).get('hits', [])
+        picks[message_id] = [hit['_source'] for hit in hits]
+    
+    return picks
+
+
+def ranked_query(request):
+    seed = {"seed": random.getrandbits(31), "field": "_seq_no"}
+    filters = [{"term": {"Cuisine": request['cuisine']}}]
+    
+    # random_score alone ranks every document of the cuisine by a per-message
+    # seed, so the top hits are a uniform sample of the whole population
+    if SEARCH_MODE == 'random':
+        return {
+            "function_score": {
+                "query": {"bool": {"filter": filters}},
+                "random_score": seed,
+                "boost_mode": "replace"
+            }
+        }
+    
+    centroid = NEIGHBORHOOD_CENTROIDS.get(' '.join((request['location'] or '').lower().split()))
+    if SEARCH_MODE == 'nearby' and centroid:
+        filters.append({
+            "geo_distance": {"distance": f"{NEARBY_RADIUS_KM}km", "Location": {"lat": centroid[0], "lon": centroid[1]}}
+        })
+    
+    # Rating (0-5) plus a log-scaled review count; a small random term keeps
+    # every email from listing the same top three
+    return {
+        "function_score": {
+            "query": {"bool": {"filter": filters}},
+            "functions": [
+                {"field_value_factor": {"field": "Rating", "missing": 0}},
+                {"field_value_factor": {"field": "NumberOfReviews", "modifier": "log1p", "missing": 0}, "weight": 0.5},
+                {"random_score": seed, "weight": 0.5}
+            ],
+            "score_mode": "sum",
+            "boost_mode": "replace"
+        }
+    }
+
+
+def check_index_generation():
+    # load_opensearch.py stamps _meta.generation on every reload; a new value
+    # means cached candidates are stale. Checked at most once per interval.
+    if not candidate_cache.generation_due():
+        return
+    try:
+        mappings = opensearch.get(f"/{INDEX}/_mapping")
+        index_name, index = next(iter(mappings.items()))
+        meta = index.get('mappings', {}).get('_meta', {})
+        candidate_cache.set_generation(meta.get('generation', index_name))
+    except Exception as e:
+        print(f"Error checking index generation: {e}")
 
 
 def send_email(to_email, cuisine, dining_time, num_people, restaurants):
@@ -108,6 +655,7 @@ def send_email(to_email, cuisine, dining_time, num_people, restaurants):
         "Enjoy your meal!"
     )
     
+    metrics.incr('SesCalls')
     ses.send_email(
         Source=SENDER_EMAIL,
         Destination={'ToAddresses': [to_email]},
@@ -116,4 +664,55 @@ def send_email(to_email, cuisine, dining_time, num_people, restaurants):
             'Body': {'Text': {'Data': body}}
         }
     )
-    print(f"Email sent to {to_email}")
\ No newline at end of file
+    metrics.incr('EmailsSent')
+    print(f"Email sent to {to_email}")
+
+
+def send_bulk_emails(ready):
+    # One SendBulkTemplatedEmail per 50 recipients; SES renders the template
+    # (see other-scripts/ses_template.py) with each recipient's data.
+    failed = []
+    for start in range(0, len(ready), SES_BULK_LIMIT):
+        chunk = ready[start:start + SES_BULK_LIMIT]
+        destinations = [
+            {
+                'Destination': {'ToAddresses': [request['email']]},
+                'ReplacementTemplateData': json.dumps(template_data(request, picked))
+            }
+            for _, request, picked in chunk
+        ]
+        try:
+            metrics.incr('SesCalls')
+            resp = ses.send_bulk_templated_email(
+                Source=SENDER_EMAIL,
+                Template=SES_TEMPLATE_NAME,
+                DefaultTemplateData=json.dumps(DEFAULT_TEMPLATE_DATA),
+                Destinations=destinations
+            )
+        except Exception as e:
+            print(f"Error sending bulk email: {e}")
+            failed.extend(message_id for message_id, _, _ in chunk)
+            continue
+        
+        # Statuses come back in the same order as the destinations
+        for (message_id, request, _), status in zip(chunk, resp.get('Status', [])):
+            if status.get('Status') == 'Success':
+                metrics.incr('EmailsSent')
+                print(f"Email sent to {request['email']}")
+            else:
+                print(f"Error sending to {request['email']}: {status.get('Status')} {status.get('Error', '')}")
+                failed.append(message_id)
+    return failed
+
+
+def template_data(request, restaurants):
+    return {
+        'cuisine': request['cuisine'],
+        'numPeople': str(request['num_people']),
+        'diningTime': request['dining_time'],
+        'restaurants': [
+            {'index': i, 'name': r.get('Name', 'Unknown'), 'address': r.get('Address', 'N/A')}
+            for i, r in enumerate(restaurants, 1)
+        ]
+    }
+
@@ -0,0 +1,103 @@
+'''
+Lightweight per-invocation instrumentation for LF2. Stage timers and counters accumulate
+in memory and flush() writes them as a single CloudWatch Embedded Metric Format (EMF) log line,
+which CloudWatch Logs turns into metrics without any extra API calls.
+Set METRICS_ENABLED=false to turn every call into a no-op.
+'''
+
+import json
+import os
+import threading
+import time
+
+ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'DiningConcierge')
+FUNCTION_NAME = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'LF2')
+
+# Concurrent sends report from several threads at once
+_lock = threading.Lock()
+_durations = {}
+_counts = {}
+# Per stage: how many timers are running, and since when the first of them
+_active = {}
+_started = {}
+
+
+class _Timer:
+    __slots__ = ('stage',)
+    
+    def __init__(self, stage):
+        self.stage = stage
+    
+    def __enter__(self):
+        # Overlapping timers of one stage count once, from the first start to
+        # the last end, so a stage never reports more than the wall time it took
+        with _lock:
+            if not _active.get(self.stage):
+                _started[self.stage] = time.perf_counter()
+            _active[self.stage] = _active.get(self.stage, 0) + 1
+        return self
+    
+    def __exit__(self, *exc_info):
+        with _lock:
+            _active[self.stage] -= 1
+            if not _active[self.stage]:
+                elapsed = (time.perf_counter() - _started.pop(self.stage)) * 1000
+                _durations[self.stage] = _durations.get(self.stage, 0) + elapsed
+        return False
+
+
+class _NoopTimer:
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+def timer(stage):
+    # Wall time spent in a stage over the invocation
+    if not ENABLED:
+        return _NOOP_TIMER
+    return _Timer(stage)
+
+
+def incr(name, value=1):
+    if not ENABLED:
+        return
+    with _lock:
+        _counts[name] = _counts.get(name, 0) + value
+
+
+def flush(**properties):
+    # Emits everything recorded since the last flush as one EMF line, then resets.
+    # Keyword arguments are logged alongside as plain (non-metric) properties.
+    if not ENABLED:
+        return
+    with _lock:
+        durations = dict(_durations)
+        counts = dict(_counts)
+        _durations.clear()
+        _counts.clear()
+    
+    definitions = [{'Name': f'{stage}Ms', 'Unit': 'Milliseconds'} for stage in durations]
+    definitions += [{'Name': name, 'Unit': 'Count'} for name in counts]
+    
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [['FunctionName']],
+                'Metrics': definitions
+            }]
+        },
+        'FunctionName': FUNCTION_NAME
+    }
+    record.update(properties)
+    record.update({f'{stage}Ms': round(ms, 2) for stage, ms in durations.items()})
+    record.update(counts)
+    print(json.dumps(record, default=str))
@@ -0,0 +1,193 @@
+'''
+This lambda function is triggered by the DynamoDB Stream of the yelp-restaurants table.
+It turns INSERT/MODIFY/REMOVE records into _bulk index/delete actions, so the restaurants
+index stays in sync without rerunning load_opensearch.py. Only the latest change per key in
+a batch is sent, and failed keys are reported as batchItemFailures so the stream replays them.
+Uses urllib3 and boto3 from the Lambda runtime, so nothing needs to be vendored.
+'''
+
+import base64
+import json
+import os
+import urllib3
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+OPENSEARCH_ENDPOINT = os.environ.get('OPENSEARCH_ENDPOINT', 'https://YOUR_DOMAIN.es.amazonaws.com')
+OPENSEARCH_USER = os.environ.get('OPENSEARCH_USER', 'master')
+OPENSEARCH_PASS = os.environ.get('OPENSEARCH_PASS', 'password')
+INDEX = os.environ.get('OPENSEARCH_INDEX', 'restaurants')
+# Match the --display-fields option load_opensearch.py was run with
+INDEX_DISPLAY_FIELDS = os.environ.get('INDEX_DISPLAY_FIELDS', 'false').lower() == 'true'
+
+BULK_MAX_DOCS = 500
+OK_STATUSES = {200, 201}
+
+deserializer = TypeDeserializer()
+
+
+class OpenSearchClient:
+    def __init__(self, endpoint, user, password):
+        self.endpoint = endpoint.rstrip('/')
+        token = base64.b64encode(f"{user}:{password}".encode()).decode()
+        self.headers = {'Authorization': f'Basic {token}', 'Content-Type': 'application/x-ndjson'}
+        # Kept across warm invocations
+        self.http = urllib3.PoolManager(maxsize=2, timeout=urllib3.Timeout(connect=2, read=30))
+    
+    def bulk(self, body):
+        r = self.http.request('POST', f"{self.endpoint}/_bulk", body=body, headers=self.headers)
+        if r.status >= 300:
+            raise RuntimeError(f"Bulk request failed: {r.status} {r.data[:200]}")
+        return json.loads(r.data)
+
+
+class LocalOpenSearch:
+    # In-memory stand-in for local runs and tests: applies _bulk bodies to a dict
+    # of index -> {id: doc}. Ids in fail_ids get a 429 item status.
+    def __init__(self, fail_ids=()):
+        self.indices = {}
+        self.fail_ids = set(fail_ids)
+        self.requests = 0
+    
+    def bulk(self, body):
+        self.requests += 1
+        lines = body.decode().splitlines()
+        items = []
+        i = 0
+        while i < len(lines):
+            op, meta = next(iter(json.loads(lines[i]).items()))
+            docs = self.indices.setdefault(meta['_index'], {})
+            if meta['_id'] in self.fail_ids:
+                status = 429
+            elif op == 'delete':
+                status = 200 if docs.pop(meta['_id'], None) is not None else 404
+            else:
+                status = 200 if meta['_id'] in docs else 201
+                docs[meta['_id']] = json.loads(lines[i + 1])
+            i += 1 if op == 'delete' else 2
+            items.append({op: {'_id': meta['_id'], 'status': status}})
+        return {'errors': not all(applied(*next(iter(item.items()))) for item in items),
+                'items': items}
+
+
+def applied(op, result):
+    # Deleting a document that was never indexed is not an error; a 404 on an
+    # index action means the index or alias is missing and has to be retried
+    return result['status'] in OK_STATUSES or (op == 'delete' and result['status'] == 404)
+
+
+opensearch = OpenSearchClient(OPENSEARCH_ENDPOINT, OPENSEARCH_USER, OPENSEARCH_PASS)
+
+
+def lambda_handler(event, context):
+    records = event.get('Records', [])
+    print(f"LF3 received {len(records)} stream records")
+    return process_stream_records(records)
+
+
+def process_stream_records(records, client=None):
+    client = client or opensearch
+    
+    # Records arrive in order per key, so the last one wins. The first sequence
+    # number of each key is where a replay has to start if that key fails.
+    latest = {}
+    first_seq = {}
+    for record in records:
+        key = deserializer.deserialize(record['dynamodb']['Keys']['BusinessID'])
+        first_seq.setdefault(key, record['dynamodb']['SequenceNumber'])
+        latest[key] = record
+    
+    failed = []
+    keys = list(latest)
+    for start in range(0, len(keys), BULK_MAX_DOCS):
+        # A record that can't be turned into an action (say, no NewImage because
+        # the stream's view type is wrong) fails on its own, like a rejected one
+        chunk = []
+        actions = []
+        for key in keys[start:start + BULK_MAX_DOCS]:
+            try:
+                actions.append(build_action(key, latest[key]))
+                chunk.append(key)
+            except Exception as e:
+                print(f"Error building action for {key}: {e}")
+                failed.append(key)
+        if not chunk:
+            continue
+        try:
+            response = client.bulk(''.join(actions).encode())
+        except Exception as e:
+            print(f"Error sending bulk request: {e}")
+            failed.extend(chunk)
+            continue
+        
+        for key, item in zip(chunk, response['items']):
+            op, result = next(iter(item.items()))
+            if not applied(op, result):
+                print(f"Error applying {op} for {key}: {result['status']} {result.get('error')}")
+                failed.append(key)
+    
+    print(f"Applied {len(keys) - len(failed)} of {len(keys)} changes")
+    
+    # Lambda replays the shard from the lowest reported sequence number, which
+    # also re-delivers every later change for the failed keys in order
+    if not failed:
+        return {'batchItemFailures': []}
+    return {'batchItemFailures': [{'itemIdentifier': min((first_seq[key] for key in failed), key=int)}]}
+
+
+def build_action(key, record):
+    if record['eventName'] == 'REMOVE':
+        return json.dumps({"delete": {"_index": INDEX, "_id": key}}) + '\n'
+    
+    item = {k: deserializer.deserialize(v) for k, v in record['dynamodb']['NewImage'].items()}
+    return (json.dumps({"index": {"_index": INDEX, "_id": key}}) + '\n'
+            + json.dumps(build_doc(item)) + '\n')
+
+
+def build_doc(item):
+    # Same document shape as load_opensearch.py
+    doc = {
+        "RestaurantID": item['BusinessID'],
+        "Cuisine": item.get('Cuisine', ''),
+        "Rating": float(item.get('Rating', 0)),
+        "NumberOfReviews": int(item.get('NumberOfReviews', 0)),
+        "ZipCode": item.get('ZipCode', '')
+    }
+    # The scraper stores 0/0 when Yelp has no coordinates
+    coordinates = item.get('Coordinates', {})
+    if coordinates.get('Latitude') and coordinates.get('Longitude'):
+        doc["Location"] = {"lat": float(coordinates['Latitude']), "lon": float(coordinates['Longitude'])}
+    if INDEX_DISPLAY_FIELDS:
+        doc.update({
+            "Name": item.get('Name', ''),
+            "Address": item.get('Address', '')
+        })
+    return doc
+
+
+def fake_stream_record(event_name, item, sequence_number):
+    # Builds a DynamoDB Stream record like Lambda delivers it (NEW_IMAGE view)
+    serializer = TypeSerializer()
+    record = {
+        'eventName': event_name,
+        'dynamodb': {
+            'Keys': {'BusinessID': serializer.serialize(item['BusinessID'])},
+            'SequenceNumber': str(sequence_number)
+        }
+    }
+    if event_name != 'REMOVE':
+        record['dynamodb']['NewImage'] = {k: serializer.serialize(v) for k, v in item.items()}
+    return record
+
+
+if __name__ == '__main__':
+    # Replay a small fake stream against the local stand-in
+    local = LocalOpenSearch(fail_ids={'b3'})
+    stream = [
+        fake_stream_record('INSERT', {'BusinessID': 'b1', 'Cuisine': 'Thai'}, 100),
+        fake_stream_record('INSERT', {'BusinessID': 'b2', 'Cuisine': 'Indian'}, 101),
+        fake_stream_record('MODIFY', {'BusinessID': 'b1', 'Cuisine': 'Japanese'}, 102),
+        fake_stream_record('INSERT', {'BusinessID': 'b3', 'Cuisine': 'Italian'}, 103),
+        fake_stream_record('REMOVE', {'BusinessID': 'b2'}, 104)
+    ]
+    print(process_stream_records(stream, local))
+    print(local.indices)
@@ -0,0 +1,287 @@
+'''
+This script replays Lex V2 code-hook events against LF1's lambda_handler, and API Gateway
+events against LF0's, with in-process stand-ins for SQS, DynamoDB and the Lex runtime.
+Each stand-in sleeps for an injectable latency, so handler overhead and the cost of
+the AWS calls can be looked at separately. It reports p50/p95/p99 and invocations per
+second per scenario. With --save/--baseline, a run is compared against an earlier one and
+the script exits non-zero when a scenario's p95 got more than --tolerance percent slower.
+'''
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import math
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-functions')
+LF1_DIR = os.path.join(ROOT, 'LF1')
+LF0_DIR = os.path.join(ROOT, 'LF0')
+
+# Both handlers create boto3 clients at import time; they only need a region
+# and (unused) credentials to do that offline. LF1's vendored SDK is used for both.
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+sys.path.insert(0, LF1_DIR)
+
+EMAIL = 'returning@example.com'
+# The returning user's saved search, as user-last-search stores it
+LAST_SEARCH = {'location': 'Manhattan', 'cuisine': 'Thai', 'diningTime': '7pm', 'numberOfPeople': '2'}
+# What LF1's email turn leaves in the lastSearch session attribute for the
+# confirm turn. Built here rather than with LF1's helpers so the same events
+# replay against versions of LF1 that predate it (those just ignore it).
+SESSION_ATTRIBUTES = {
+    'lastSearch': json.dumps([1, EMAIL] + [LAST_SEARCH[field] for field in ['location', 'cuisine', 'diningTime', 'numberOfPeople']],
+                             separators=(',', ':'))
+}
+SLOTS = {
+    'Location': 'Manhattan',
+    'Cuisine': 'Thai',
+    'DiningTime': '7pm',
+    'NumberOfPeople': '2',
+    'Email': EMAIL
+}
+
+
+def load_handler(name, directory):
+    # Both files are called lambda_function.py, so load each under its own name
+    spec = importlib.util.spec_from_file_location(name, os.path.join(directory, 'lambda_function.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Latency:
+    # Sleeps `ms` milliseconds, give or take up to `jitter` percent
+    def __init__(self, ms, jitter):
+        self.ms = ms
+        self.jitter = jitter
+
+    def wait(self):
+        if self.ms > 0:
+            spread = self.ms * self.jitter / 100
+            time.sleep(max(0, random.uniform(self.ms - spread, self.ms + spread)) / 1000)
+
+
+class LocalSQS:
+    def __init__(self, latency):
+        self.latency = latency
+        self.sent = 0
+
+    def send_message(self, **kwargs):
+        self.latency.wait()
+        self.sent += 1
+        return {'MessageId': f'bench-{self.sent}'}
+
+
+class LocalTable:
+    # Just enough of a boto3 Table for user-last-search
+    def __init__(self, latency):
+        self.latency = latency
+        self.items = {}
+        self.reads = 0
+        self.writes = 0
+
+    def get_item(self, Key):
+        self.latency.wait()
+        self.reads += 1
+        item = self.items.get(Key['Email'])
+        return {'Item': dict(item)} if item else {}
+
+    def put_item(self, Item):
+        self.latency.wait()
+        self.writes += 1
+        self.items[Item['Email']] = dict(Item)
+        return {}
+
+
+class LocalLex:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def recognize_text(self, **kwargs):
+        self.latency.wait()
+        return {
+            'messages': [{'contentType': 'PlainText', 'content': "Welcome! Have you used our service before?"}],
+            'sessionState': {'intent': {'name': 'GreetingIntent', 'state': 'Fulfilled'}}
+        }
+
+
+def lex_event(intent, source='DialogCodeHook', slots=None, attributes=None, text='hello'):
+    # Shaped like what Lex V2 sends a code hook
+    slots = slots or {}
+    event = {
+        'messageVersion': '1.0',
+        'invocationSource': source,
+        'inputMode': 'Text',
+        'responseContentType': 'text/plain; charset=utf-8',
+        'sessionId': '123456789012-bench',
+        'inputTranscript': text,
+        'bot': {'id': 'BENCHBOT', 'name': 'DiningConcierge', 'aliasId': 'TSTALIASID', 'localeId': 'en_US', 'version': 'DRAFT'},
+        'interpretations': [{'intent': {'name': intent, 'state': 'InProgress', 'confirmationState': 'None'}, 'nluConfidence': 0.95}],
+        'sessionState': {
+            'intent': {
+                'name': intent,
+                'slots': {
+                    name: {'shape': 'Scalar', 'value': {'originalValue': value, 'interpretedValue': value, 'resolvedValues': [value]}}
+                    if value else None
+                    for name, value in slots.items()
+                },
+                'state': 'InProgress',
+                'confirmationState': 'None'
+            },
+            'originatingRequestId': 'bench'
+        }
+    }
+    if attributes is not None:
+        event['sessionState']['sessionAttributes'] = attributes
+    return event
+
+
+def api_event(text):
+    # Shaped like what API Gateway's proxy integration hands LF0
+    return {
+        'resource': '/chatbot',
+        'path': '/chatbot',
+        'httpMethod': 'POST',
+        'headers': {'Content-Type': 'application/json'},
+        'queryStringParameters': {'sessionId': 'bench-session'},
+        'body': json.dumps({'messages': [{'type': 'unstructured', 'unstructured': {'text': text}}]}),
+        'isBase64Encoded': False
+    }
+
+
+def lf1_scenarios():
+    partial = dict(SLOTS, DiningTime=None, NumberOfPeople=None, Email=None)
+    returning = {'Email': EMAIL, 'ConfirmSuggestion': None}
+    confirmed = {'Email': EMAIL, 'ConfirmSuggestion': 'yes'}
+    # Turns that read user-last-search run against a cold cache (cleared before
+    # every invocation, so each one pays the DynamoDB read) and a warm one
+    return {
+        'lf1.greeting': lex_event('GreetingIntent'),
+        'lf1.thank_you': lex_event('ThankYouIntent'),
+        'lf1.new_user': lex_event('NewUserIntent'),
+        'lf1.dining.dialog': lex_event('DiningSuggestionsIntent', slots=partial),
+        'lf1.dining.bad_location': lex_event('DiningSuggestionsIntent', slots=dict(partial, Location='Boston')),
+        'lf1.dining.fulfillment': lex_event('DiningSuggestionsIntent', 'FulfillmentCodeHook', slots=SLOTS),
+        'lf1.returning.no_email': lex_event('ReturningUserIntent', slots={'Email': None, 'ConfirmSuggestion': None}),
+        'lf1.returning.email': lex_event('ReturningUserIntent', slots=returning),
+        'lf1.returning.email.warm_cache': lex_event('ReturningUserIntent', slots=returning),
+        'lf1.returning.unknown': lex_event('ReturningUserIntent', slots=dict(returning, Email='nobody@example.com')),
+        'lf1.returning.confirm': lex_event('ReturningUserIntent', slots=confirmed, attributes=SESSION_ATTRIBUTES),
+        'lf1.returning.confirm_no_session': lex_event('ReturningUserIntent', slots=confirmed),
+        'lf1.returning.confirm_no_session.warm_cache': lex_event('ReturningUserIntent', slots=confirmed),
+        'lf1.returning.decline': lex_event('ReturningUserIntent', slots=dict(confirmed, ConfirmSuggestion='no'))
+    }
+
+
+def lf0_scenarios():
+    return {
+        'lf0.message': api_event("I need restaurant suggestions"),
+        'lf0.empty': {'body': json.dumps({'messages': []})}
+    }
+
+
+def percentile(samples, p):
+    # Nearest rank on an already sorted list
+    index = max(0, min(len(samples) - 1, math.ceil(p / 100 * len(samples)) - 1))
+    return samples[index]
+
+
+def replay(handler, event, iterations, warmup, reset=None):
+    # Handlers print every event; that output is part of their cost in Lambda
+    # too, so it's still produced, just not shown. reset() runs untimed before
+    # each invocation.
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()) as sink:
+        for i in range(warmup + iterations):
+            if reset:
+                reset()
+            start = time.perf_counter()
+            handler(json.loads(json.dumps(event)), None)
+            elapsed = time.perf_counter() - start
+            if i >= warmup:
+                timings.append(elapsed)
+            sink.seek(0)
+            sink.truncate()
+    timings.sort()
+    return {
+        'p50_ms': percentile(timings, 50) * 1000,
+        'p95_ms': percentile(timings, 95) * 1000,
+        'p99_ms': percentile(timings, 99) * 1000,
+        'per_second': len(timings) / sum(timings)
+    }
+
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    # A regression has to be both relatively and absolutely larger than noise
+    regressions = []
+    for name, stats in results.items():
+        before = baseline.get(name)
+        if (before and stats['p95_ms'] > before['p95_ms'] * (1 + tolerance / 100)
+                and stats['p95_ms'] - before['p95_ms'] > min_delta_ms):
+            regressions.append(f"{name}: p95 {before['p95_ms']:.3f} -> {stats['p95_ms']:.3f} ms")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay Lex conversations against LF1 and LF0")
+    parser.add_argument('--iterations', type=int, default=500, help="timed invocations per scenario")
+    parser.add_argument('--warmup', type=int, default=20, help="untimed invocations before each scenario")
+    parser.add_argument('--sqs-ms', type=float, default=0, help="latency added to every SQS call")
+    parser.add_argument('--dynamodb-ms', type=float, default=0, help="latency added to every DynamoDB call")
+    parser.add_argument('--lex-ms', type=float, default=0, help="latency added to every Lex runtime call")
+    parser.add_argument('--jitter', type=float, default=20, help="latency spread, in percent either way")
+    parser.add_argument('--only', help="run just the scenarios whose name starts with this")
+    parser.add_argument('--save', help="write the results as JSON to this file")
+    parser.add_argument('--baseline', help="compare against results saved earlier with --save")
+    parser.add_argument('--tolerance', type=float, default=10, help="allowed p95 slowdown against the baseline, in percent")
+    parser.add_argument('--min-delta-ms', type=float, default=0.05, help="ignore p95 slowdowns smaller than this")
+    args = parser.parse_args()
+
+    random.seed(0)
+    lf1 = load_handler('lf1_lambda_function', LF1_DIR)
+    lf0 = load_handler('lf0_lambda_function', LF0_DIR)
+    lf1.sqs = LocalSQS(Latency(args.sqs_ms, args.jitter))
+    lf1.table = LocalTable(Latency(args.dynamodb_ms, args.jitter))
+    lf0.lex = LocalLex(Latency(args.lex_ms, args.jitter))
+    lf1.table.items[EMAIL] = dict(LAST_SEARCH, Email=EMAIL, timestamp='2026-01-01T19:00:00')
+
+    scenarios = [(name, lf1.lambda_handler, event) for name, event in lf1_scenarios().items()]
+    scenarios += [(name, lf0.lambda_handler, event) for name, event in lf0_scenarios().items()]
+    if args.only:
+        scenarios = [scenario for scenario in scenarios if scenario[0].startswith(args.only)]
+
+    print(f"Latency: SQS {args.sqs_ms} ms, DynamoDB {args.dynamodb_ms} ms, Lex {args.lex_ms} ms (±{args.jitter}%)")
+    print(f"{'scenario':44} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'inv/s':>10}")
+    results = {}
+    # Versions of LF1 without the warm-container cache always read DynamoDB
+    cache = getattr(lf1, 'last_search_cache', None)
+    def cold_cache():
+        cache.entries.clear()
+
+    for name, handler, event in scenarios:
+        reset = None if cache is None or name.endswith('.warm_cache') else cold_cache
+        stats = replay(handler, event, args.iterations, args.warmup, reset)
+        results[name] = stats
+        print(f"{name:44} {stats['p50_ms']:9.3f} {stats['p95_ms']:9.3f} {stats['p99_ms']:9.3f} {stats['per_second']:10.1f}")
+    print(f"DynamoDB reads: {lf1.table.reads}, writes: {lf1.table.writes}; SQS sends: {lf1.sqs.sent}")
+    if cache is not None:
+        print(f"Last-search cache: {cache.stats()}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_delta_ms)
+        for regression in regressions:
+            print(f"  REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No scenario's p95 regressed by more than {args.tolerance}%")
@@ -1,60 +1,372 @@
 '''
 This script loads the data from the DynamoDB table into the OpenSearch index.
 so LF2 can query restaurants by cuisine. It creates the index and bulk-loads documents.
+With --reindex it builds a new restaurants_v<N> index off to the side and atomically
+points the restaurants alias at it once the load succeeded, so LF2 never sees a partial index.
+LF3's stream trigger is paused for the duration, so changes made during the load queue up in
+the stream and are applied to the new index once the alias has moved.
 '''
 
+import argparse
 import boto3
 import json
+import random
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from decimal import Decimal
 import os
+import queue
+import threading
+import time
 
 OPENSEARCH_ENDPOINT = "https://search-restaurants-rvohhm6ykvzhc3quzibevfmc4m.us-east-1.es.amazonaws.com"
 MASTER_USER = os.getenv('MASTER_USER')
 MASTER_PASS = os.getenv('MASTER_PASS')
 INDEX = "restaurants"
+# --reindex builds restaurants_v<N> and points the INDEX alias at it; the
+# index the alias pointed to before is kept for rollback
+VERSION_PREFIX = f"{INDEX}_v"
+REPLICAS = 1
+GENERATION = str(int(time.time()))
+# Indexed fields LF2 filters and ranks on
+PROPERTIES = {
+    "RestaurantID": {"type": "keyword"},
+    "Cuisine": {"type": "keyword"},
+    "Location": {"type": "geo_point"},
+    "Rating": {"type": "scaled_float", "scaling_factor": 10},
+    "NumberOfReviews": {"type": "integer"},
+    "ZipCode": {"type": "keyword"}
+}
+# Fields LF2 needs to build the email straight from search hits
+DISPLAY_FIELDS = {
+    "Name": {"type": "keyword", "index": False},
+    "Address": {"type": "keyword", "index": False}
+}
+
+# _bulk chunks are capped by document count and by request size
+BULK_MAX_DOCS = 500
+BULK_MAX_BYTES = 5 * 1024 * 1024
+BULK_SENDERS = 4
+BULK_MAX_RETRIES = 5
+# Item statuses worth retrying; anything else is a bad document
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Parallel scan of the table; pages wait in a bounded queue for the indexer
+SCAN_SEGMENTS = 4
+SCAN_QUEUE_PAGES = 8
+# LF3 syncs table changes into the alias; --reindex pauses its stream trigger
+LF3_FUNCTION_NAME = os.getenv('LF3_FUNCTION_NAME', 'LF3')
+MAPPING_WAIT_SECONDS = 120
 
 dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
 table = dynamodb.Table('yelp-restaurants')
+lambda_client = boto3.client('lambda', region_name='us-east-1')
+
+# One pooled session shared by all bulk senders
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=BULK_SENDERS))
+session.auth = HTTPBasicAuth(MASTER_USER, MASTER_PASS)
 
-def create_index():
-    url = f"{OPENSEARCH_ENDPOINT}/{INDEX}"
+def create_index(display_fields=False, index=INDEX, settings=None):
+    url = f"{OPENSEARCH_ENDPOINT}/{index}"
+    properties = dict(PROPERTIES)
+    if display_fields:
+        properties.update(DISPLAY_FIELDS)
     body = {
         "mappings": {
-            "properties": {
-                "RestaurantID": {"type": "keyword"},
-                "Cuisine": {"type": "keyword"}
-            }
+            "_meta": {"generation": GENERATION},
+            "properties": properties
         }
     }
-    r = requests.put(url, json=body, auth=HTTPBasicAuth(MASTER_USER, MASTER_PASS))
+    if settings:
+        body["settings"] = settings
+    r = session.put(url, json=body)
     print("Create index:", r.status_code, r.text)
+    return r.ok
+
+def build_doc(item, display_fields=False):
+    # DynamoDB numbers come back as Decimal, which JSON can't encode
+    doc = {
+        "RestaurantID": item['BusinessID'],
+        "Cuisine": item.get('Cuisine', ''),
+        "Rating": float(item.get('Rating', 0)),
+        "NumberOfReviews": int(item.get('NumberOfReviews', 0)),
+        "ZipCode": item.get('ZipCode', '')
+    }
+    # The scraper stores 0/0 when Yelp has no coordinates
+    coordinates = item.get('Coordinates', {})
+    if coordinates.get('Latitude') and coordinates.get('Longitude'):
+        doc["Location"] = {"lat": float(coordinates['Latitude']), "lon": float(coordinates['Longitude'])}
+    if display_fields:
+        doc.update({
+            "Name": item.get('Name', ''),
+            "Address": item.get('Address', '')
+        })
+    return doc
 
-def load_data():
-    # Scan all items from DynamoDB
-    response = table.scan()
-    items = response['Items']
+def scan_items(display_fields=False):
+    # Yields every item of the table while SCAN_SEGMENTS threads scan disjoint
+    # segments. The queue is bounded, so when indexing falls behind the scanners
+    # block and memory stays flat however large the table gets.
+    fields = ['BusinessID', 'Cuisine', 'Coordinates', 'Rating', 'NumberOfReviews', 'ZipCode']
+    fields += list(DISPLAY_FIELDS) if display_fields else []
+    pages = queue.Queue(maxsize=SCAN_QUEUE_PAGES)
+    finished = object()
     
-    # Handle pagination
-    while 'LastEvaluatedKey' in response:
-        response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
-        items.extend(response['Items'])
+    def scan_segment(segment):
+        kwargs = {
+            'TableName': table.name,
+            'Segment': segment,
+            'TotalSegments': SCAN_SEGMENTS,
+            # Name is a reserved word, so every attribute goes through a placeholder
+            'ProjectionExpression': ', '.join(f'#{f}' for f in fields),
+            'ExpressionAttributeNames': {f'#{f}': f for f in fields}
+        }
+        try:
+            while True:
+                response = table.meta.client.scan(**kwargs)
+                pages.put(response['Items'])
+                if 'LastEvaluatedKey' not in response:
+                    break
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        except Exception as e:
+            pages.put(e)
+        finally:
+            pages.put(finished)
     
-    print(f"Loading {len(items)} items into OpenSearch...")
+    for segment in range(SCAN_SEGMENTS):
+        threading.Thread(target=scan_segment, args=(segment,), daemon=True).start()
     
-    for item in items:
-        doc = {
-            "RestaurantID": item['BusinessID'],
-            "Cuisine": item.get('Cuisine', '')
-        }
-        url = f"{OPENSEARCH_ENDPOINT}/{INDEX}/_doc/{item['BusinessID']}"
-        r = requests.put(url, json=doc, auth=HTTPBasicAuth(MASTER_USER, MASTER_PASS))
-        if r.status_code not in [200, 201]:
-            print(f"Error: {r.text}")
+    remaining = SCAN_SEGMENTS
+    while remaining:
+        page = pages.get()
+        if page is finished:
+            remaining -= 1
+        elif isinstance(page, Exception):
+            raise page
+        else:
+            yield from page
+
+def load_data(display_fields=False, index=INDEX):
+    print(f"Loading items into {index}...")
+    
+    # Scanned pages flow straight into the bulk indexer
+    docs = (build_doc(item, display_fields) for item in scan_items(display_fields))
+    indexed, failed = bulk_index(docs, index)
+    
+    print(f"Done loading data! Indexed {indexed}, failed {failed}")
+    return indexed, failed
+
+def bulk_chunks(docs, index=INDEX):
+    # Streams docs as NDJSON action/source line pairs, cut into chunks that stay
+    # under BULK_MAX_DOCS documents and BULK_MAX_BYTES bytes
+    chunk, size = [], 0
+    for doc in docs:
+        action = json.dumps({"index": {"_index": index, "_id": doc['RestaurantID']}})
+        lines = (action + '\n' + json.dumps(doc) + '\n').encode()
+        if chunk and (len(chunk) >= BULK_MAX_DOCS or size + len(lines) > BULK_MAX_BYTES):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(lines)
+        size += len(lines)
+    if chunk:
+        yield chunk
+
+def send_bulk(chunk):
+    # Sends one chunk, then resends only the items that failed with a retryable
+    # status. Returns (indexed, failed) counts.
+    indexed = failed = 0
+    for attempt in range(BULK_MAX_RETRIES + 1):
+        if attempt:
+            time.sleep(random.uniform(0, min(10.0, 0.5 * 2 ** attempt)))
+        
+        r = session.post(f"{OPENSEARCH_ENDPOINT}/_bulk", data=b''.join(chunk),
+                         headers={'Content-Type': 'application/x-ndjson'}, timeout=60)
+        if r.status_code in RETRYABLE_STATUSES:
+            print(f"Bulk request throttled ({r.status_code}), retrying {len(chunk)} docs")
+            continue
+        r.raise_for_status()
+        
+        retry = []
+        for lines, item in zip(chunk, r.json()['items']):
+            result = item['index']
+            if result['status'] < 300:
+                indexed += 1
+            elif result['status'] in RETRYABLE_STATUSES:
+                retry.append(lines)
+            else:
+                print(f"Error indexing {result['_id']}: {result.get('error')}")
+                failed += 1
+        
+        if not retry:
+            return indexed, failed
+        chunk = retry
+    
+    print(f"Giving up on {len(chunk)} docs after {BULK_MAX_RETRIES} retries")
+    return indexed, failed + len(chunk)
+
+def bulk_index(docs, index=INDEX):
+    # A few senders share the pooled session; at most two chunks per sender are
+    # in flight so a large export never sits in memory all at once
+    indexed = failed = 0
+    in_flight = set()
+    
+    def collect(done):
+        nonlocal indexed, failed
+        for future in done:
+            ok, bad = future.result()
+            indexed += ok
+            failed += bad
     
-    print("Done loading data!")
+    with ThreadPoolExecutor(max_workers=BULK_SENDERS) as executor:
+        for chunk in bulk_chunks(docs, index):
+            if len(in_flight) >= BULK_SENDERS * 2:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight.add(executor.submit(send_bulk, chunk))
+        collect(wait(in_flight)[0])
+    
+    return indexed, failed
+
+# LF2 caches cuisine -> restaurant ids and flushes its cache when this changes
+def mark_generation(index=INDEX):
+    url = f"{OPENSEARCH_ENDPOINT}/{index}/_mapping"
+    body = {"_meta": {"generation": GENERATION}}
+    r = session.put(url, json=body)
+    print("Mark generation:", GENERATION, r.status_code)
+
+def has_geo_location(index=INDEX):
+    # Whether the live mapping (of the index or whatever the alias points at)
+    # has Location as a geo_point, as SEARCH_MODE=nearby needs
+    r = session.get(f"{OPENSEARCH_ENDPOINT}/{index}/_mapping")
+    if r.status_code != 200:
+        return False
+    return all(
+        mapping['mappings'].get('properties', {}).get('Location', {}).get('type') == 'geo_point'
+        for mapping in r.json().values()
+    )
+
+def list_versions():
+    # Existing restaurants_v<N> indices, oldest first
+    r = session.get(f"{OPENSEARCH_ENDPOINT}/_cat/indices/{VERSION_PREFIX}*", params={'format': 'json', 'h': 'index'})
+    r.raise_for_status()
+    names = [row['index'] for row in r.json()]
+    return sorted(int(name[len(VERSION_PREFIX):]) for name in names if name[len(VERSION_PREFIX):].isdigit())
+
+def swap_alias(new_index):
+    # One _aliases call moves the alias, so searches flip from the old index to
+    # the new one atomically. A plain index left by the non-reindex mode, which
+    # holds the alias name, is removed in the same call. Returns the indices
+    # the alias pointed to before.
+    actions = [{"add": {"index": new_index, "alias": INDEX}}]
+    r = session.get(f"{OPENSEARCH_ENDPOINT}/_alias/{INDEX}")
+    current = list(r.json()) if r.status_code == 200 else []
+    for index in current:
+        if index != new_index:
+            actions.insert(0, {"remove": {"index": index, "alias": INDEX}})
+    if r.status_code == 404 and session.head(f"{OPENSEARCH_ENDPOINT}/{INDEX}").status_code == 200:
+        actions.append({"remove_index": {"index": INDEX}})
+    
+    r = session.post(f"{OPENSEARCH_ENDPOINT}/_aliases", json={"actions": actions})
+    r.raise_for_status()
+    print(f"Alias {INDEX} -> {new_index}")
+    return current
+
+def stream_mappings():
+    # LF3's enabled event source mappings on the yelp-restaurants stream
+    try:
+        pages = lambda_client.get_paginator('list_event_source_mappings').paginate(FunctionName=LF3_FUNCTION_NAME)
+        mappings = [m for page in pages for m in page['EventSourceMappings']]
+    except lambda_client.exceptions.ResourceNotFoundException:
+        return []
+    return [m['UUID'] for m in mappings
+            if f":table/{table.name}/stream/" in m['EventSourceArn'] and m['State'] in ('Enabled', 'Enabling', 'Updating')]
+
+def set_stream_sync(uuids, enabled):
+    # Waits for the mappings to settle; once Disabled, LF3 gets no new batches
+    # and the stream keeps its position, so nothing is skipped on re-enable
+    for uuid in uuids:
+        lambda_client.update_event_source_mapping(UUID=uuid, Enabled=enabled)
+    target = 'Enabled' if enabled else 'Disabled'
+    deadline = time.monotonic() + MAPPING_WAIT_SECONDS
+    for uuid in uuids:
+        while lambda_client.get_event_source_mapping(UUID=uuid)['State'] != target:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Event source mapping {uuid} not {target} after {MAPPING_WAIT_SECONDS}s")
+            time.sleep(2)
+    print(f"LF3 stream sync {'resumed' if enabled else 'paused'} ({len(uuids)} mappings)")
+
+def reindex(display_fields=False):
+    versions = list_versions()
+    new_index = f"{VERSION_PREFIX}{(versions[-1] if versions else 0) + 1}"
+    
+    # Otherwise LF3 writes made during the scan land in the old index and are
+    # lost with the swap. Paused, they wait in the stream (kept 24 hours) and
+    # replay into the alias, by then the new index, once sync resumes.
+    paused = stream_mappings()
+    if not paused:
+        print(f"No enabled {LF3_FUNCTION_NAME} stream trigger found; changes during the load are not synced")
+    try:
+        set_stream_sync(paused, False)
+        build_and_swap(display_fields, new_index)
+    finally:
+        set_stream_sync(paused, True)
+
+def build_and_swap(display_fields, new_index):
+    # No refreshes or replicas while loading; both are restored afterwards
+    if not create_index(display_fields, new_index,
+                        {"index": {"refresh_interval": "-1", "number_of_replicas": 0}}):
+        raise RuntimeError(f"Could not create {new_index}")
+    
+    # Never point the alias at a partial index, and never leave one behind
+    # for the cleanup below to mistake for a good version
+    try:
+        indexed, failed = load_data(display_fields, new_index)
+        if failed or not indexed:
+            raise RuntimeError(f"Reindex into {new_index} failed ({failed} docs), alias unchanged")
+        
+        r = session.put(f"{OPENSEARCH_ENDPOINT}/{new_index}/_settings",
+                        json={"index": {"refresh_interval": None}})
+        r.raise_for_status()
+        session.post(f"{OPENSEARCH_ENDPOINT}/{new_index}/_refresh").raise_for_status()
+        r = session.post(f"{OPENSEARCH_ENDPOINT}/{new_index}/_forcemerge",
+                         params={'max_num_segments': 1}, timeout=600)
+        print("Force merge:", r.status_code)
+        # Replicas last, so they copy the merged segments instead of merging again
+        r = session.put(f"{OPENSEARCH_ENDPOINT}/{new_index}/_settings",
+                        json={"index": {"number_of_replicas": REPLICAS}})
+        r.raise_for_status()
+        
+        previous = swap_alias(new_index)
+    except BaseException:
+        r = session.delete(f"{OPENSEARCH_ENDPOINT}/{new_index}")
+        print(f"Deleted unfinished {new_index}:", r.status_code)
+        raise
+    
+    # Keep what the alias pointed to before for a quick rollback, drop the rest
+    keep = {new_index, *previous}
+    for version in list_versions():
+        name = f"{VERSION_PREFIX}{version}"
+        if name not in keep:
+            r = session.delete(f"{OPENSEARCH_ENDPOINT}/{name}")
+            print(f"Deleted {name}:", r.status_code)
 
 if __name__ == '__main__':
-    create_index()
-    load_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Load yelp-restaurants into OpenSearch")
+    parser.add_argument('--display-fields', action='store_true',
+                        help="also store Name/Address for LF2's INDEX_DISPLAY_FIELDS mode")
+    parser.add_argument('--reindex', action='store_true',
+                        help="load into a new restaurants_v<N> index and swap the restaurants alias to it")
+    args = parser.parse_args()
+    
+    if args.reindex:
+        # The new index carries its own generation stamp from create_index
+        reindex(args.display_fields)
+    else:
+        # An index from before Location existed would map it dynamically as an
+        # object of two floats; the mapping can only change by reindexing
+        if not create_index(args.display_fields) and not has_geo_location():
+            raise SystemExit(f"{INDEX} exists without a geo_point Location mapping; rerun with --reindex")
+        load_data(args.display_fields)
+        mark_generation()
\ No newline at end of file
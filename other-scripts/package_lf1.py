@@ -0,0 +1,191 @@
+'''
+This script builds LF1's deployment zip. LF1 only talks to SQS and DynamoDB, but its folder
+vendors the whole SDK (boto3, botocore with models for 400+ services, s3transfer, dateutil,
+jmespath), which Lambda has to download and unpack on every cold start. Two slimmer builds:
+
+  --mode runtime  just lambda_function.py; boto3 comes from the Lambda Python runtime
+  --mode pruned   the vendored SDK with botocore/data and boto3/data cut down to the services
+                  LF1 uses, so the SDK version stays pinned (the default)
+  --mode full     the whole vendored folder, precompiled
+
+Python files are precompiled with unchecked-hash .pyc, since /var/task is read-only and zip
+timestamps are too coarse for timestamp-checked .pyc to be trusted. The script prints the
+artifact's size next to that of the folder zipped as it is deployed today (no .pyc, so every
+cold start compiles it), and times a cold import of each.
+'''
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+LF1_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-functions', 'LF1')
+DIST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dist')
+# Service models LF1 loads: clients for sqs and dynamodb, plus the dynamodb resource
+KEEP_SERVICES = ['sqs', 'dynamodb']
+# Only used by documentation/CLI tooling, never at runtime
+DROP_FILES = ['examples-1.json']
+DROP_DIRS = ['__pycache__', 'bin']
+RUNTIME_VERSION = '3.12'
+IMPORT_RUNS = 5
+
+
+def copy_tree(build_dir, mode):
+    if mode == 'runtime':
+        shutil.copy2(os.path.join(LF1_DIR, 'lambda_function.py'), build_dir)
+        return
+    shutil.copytree(LF1_DIR, build_dir, dirs_exist_ok=True,
+                    ignore=shutil.ignore_patterns(*DROP_DIRS, '*.pyc'))
+    if mode == 'pruned':
+        prune_models(os.path.join(build_dir, 'botocore', 'data'))
+        prune_models(os.path.join(build_dir, 'boto3', 'data'))
+
+
+def prune_models(data_dir):
+    # Keeps the top-level files (endpoints, partitions, retry config) and the
+    # newest API version of each kept service
+    for name in os.listdir(data_dir):
+        path = os.path.join(data_dir, name)
+        if not os.path.isdir(path):
+            continue
+        if name not in KEEP_SERVICES:
+            shutil.rmtree(path)
+            continue
+        versions = sorted(version for version in os.listdir(path) if os.path.isdir(os.path.join(path, version)))
+        for version in versions[:-1]:
+            shutil.rmtree(os.path.join(path, version))
+        for root, _, files in os.walk(path):
+            for file in files:
+                if file in DROP_FILES:
+                    os.remove(os.path.join(root, file))
+
+
+def precompile(python, build_dir):
+    subprocess.run(
+        [python, '-m', 'compileall', '-q', '-j', '0', '--invalidation-mode', 'unchecked-hash', build_dir],
+        check=True
+    )
+
+
+def write_zip(build_dir, path):
+    # Sorted entries with a fixed timestamp, so the same tree gives the same zip
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
+        for root, dirs, files in os.walk(build_dir):
+            dirs.sort()
+            for file in sorted(files):
+                full = os.path.join(root, file)
+                info = zipfile.ZipInfo(os.path.relpath(full, build_dir), date_time=(1980, 1, 1, 0, 0, 0))
+                info.external_attr = 0o644 << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with open(full, 'rb') as f:
+                    zf.writestr(info, f.read(), compresslevel=9)
+
+
+def tree_size(path):
+    total = 0
+    count = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            total += os.path.getsize(os.path.join(root, file))
+            count += 1
+    return total, count
+
+
+def cold_import(python, paths):
+    # Fresh interpreter per run, as on a cold start; LF1 builds its clients at import
+    env = {
+        'PATH': os.environ.get('PATH', ''),
+        'PYTHONPATH': os.pathsep.join(paths),
+        'PYTHONDONTWRITEBYTECODE': '1',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_ACCESS_KEY_ID': 'package',
+        'AWS_SECRET_ACCESS_KEY': 'package',
+        'SQS_QUEUE_URL': 'https://sqs.us-east-1.amazonaws.com/000000000000/Q1'
+    }
+    code = 'import time; start = time.perf_counter(); import lambda_function; print(time.perf_counter() - start)'
+    timings = []
+    for _ in range(IMPORT_RUNS):
+        result = subprocess.run([python, '-s', '-c', code], env=env, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(result.stderr.strip().splitlines()[-1])
+            return None
+        timings.append(float(result.stdout))
+    return statistics.median(timings) * 1000
+
+
+def human(size):
+    if size < 1024 * 1024:
+        return f"{size / 1024:.0f} KB"
+    return f"{size / 1024 / 1024:.1f} MB"
+
+
+def build(mode, python, output=None, compile=True):
+    os.makedirs(DIST_DIR, exist_ok=True)
+    output = output or os.path.join(DIST_DIR, f'LF1-{mode}.zip')
+    build_dir = tempfile.mkdtemp(prefix=f'lf1-{mode}-')
+    try:
+        copy_tree(build_dir, mode)
+        if compile:
+            precompile(python, build_dir)
+        write_zip(build_dir, output)
+        size, files = tree_size(build_dir)
+        print(f"Built {os.path.relpath(output)}: {human(os.path.getsize(output))} zipped, {human(size)} unpacked, {files} files")
+    finally:
+        shutil.rmtree(build_dir)
+    return output
+
+
+def import_time(python, artifacts):
+    # Unpacks each zip into its own directory, first on the path first
+    paths = []
+    try:
+        for artifact in artifacts:
+            paths.append(tempfile.mkdtemp(prefix='lf1-import-'))
+            with zipfile.ZipFile(artifact) as zf:
+                zf.extractall(paths[-1])
+        return cold_import(python, paths)
+    finally:
+        for path in paths:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build LF1's deployment zip")
+    parser.add_argument('--mode', choices=['runtime', 'pruned', 'full'], default='pruned')
+    parser.add_argument('--output', help="zip to write (default dist/LF1-<mode>.zip)")
+    parser.add_argument('--python', default=sys.executable,
+                        help=f"interpreter to precompile and time with; should match the Lambda runtime (python{RUNTIME_VERSION})")
+    parser.add_argument('--no-compare', action='store_true', help="skip building the full folder for the size/import comparison")
+    args = parser.parse_args()
+
+    version = subprocess.run([args.python, '-c', 'import sys; print("%d.%d" % sys.version_info[:2])'],
+                             capture_output=True, text=True, check=True).stdout.strip()
+    if version != RUNTIME_VERSION:
+        print(f"Warning: precompiling with Python {version}; the python{RUNTIME_VERSION} runtime will ignore these .pyc files")
+
+    artifact = build(args.mode, args.python, args.output)
+    if args.no_compare:
+        sys.exit(0)
+
+    # What gets deployed today: the whole folder, no .pyc
+    current = build('full', args.python, os.path.join(DIST_DIR, 'LF1-current.zip'), compile=False)
+    rows = [('current', current, [current]), (args.mode, artifact, [artifact])]
+    sdk_dir = None
+    if args.mode == 'runtime':
+        # The runtime build leans on the Lambda runtime's SDK, which ships every
+        # model precompiled; a precompiled full build stands in for it
+        sdk_dir = tempfile.mkdtemp(prefix='lf1-sdk-')
+        sdk = build('full', args.python, os.path.join(sdk_dir, 'sdk.zip'))
+        rows[1] = (args.mode, artifact, [artifact, sdk])
+
+    print(f"\n{'build':10} {'zipped':>10} {'cold import':>12}")
+    for mode, path, artifacts in rows:
+        ms = import_time(args.python, artifacts)
+        timing = f"{ms:.0f} ms" if ms is not None else 'failed'
+        print(f"{mode:10} {human(os.path.getsize(path)):>10} {timing:>12}")
+    if sdk_dir:
+        shutil.rmtree(sdk_dir)
@@ -0,0 +1,37 @@
+'''
+This script creates (or updates) the SES template LF2 uses for bulk suggestion emails.
+It is safe to run on every deploy: an existing template is overwritten in place.
+Set SES_TEMPLATE_NAME on LF2 to the same name to switch it to SendBulkTemplatedEmail.
+'''
+
+import boto3
+import os
+
+TEMPLATE_NAME = os.getenv('SES_TEMPLATE_NAME', 'DiningSuggestions')
+
+ses = boto3.client('ses', region_name='us-east-1')
+
+# Rendered per recipient from LF2's template_data(). Triple braces skip
+# Handlebars' HTML escaping, which SES applies to the text part too, so a name
+# like "Joe's" reads the same as in LF2's non-template emails.
+TEMPLATE = {
+    'TemplateName': TEMPLATE_NAME,
+    'SubjectPart': 'Your {{{cuisine}}} Restaurant Suggestions!',
+    'TextPart': (
+        "Hello! Here are my {{{cuisine}}} restaurant suggestions for "
+        "{{{numPeople}}} people, for today at {{{diningTime}}}:\n\n"
+        "{{#each restaurants}}{{index}}. {{{name}}}, located at {{{address}}}\n{{/each}}\n"
+        "Enjoy your meal!"
+    )
+}
+
+def deploy_template():
+    try:
+        ses.create_template(Template=TEMPLATE)
+        print(f"Created template {TEMPLATE_NAME}")
+    except ses.exceptions.AlreadyExistsException:
+        ses.update_template(Template=TEMPLATE)
+        print(f"Updated template {TEMPLATE_NAME}")
+
+if __name__ == '__main__':
+    deploy_template()
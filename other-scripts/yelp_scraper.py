@@ -1,14 +1,42 @@
+import argparse
 import requests
 import boto3
+import gzip
+import hashlib
 import json
+import math
+import queue
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
 from decimal import Decimal
+from requests.adapters import HTTPAdapter
 import os
 
 YELP_API_KEY = os.getenv('YELP_API_KEY')
 YELP_HEADERS = {"Authorization": f"Bearer {YELP_API_KEY}"}
 YELP_SEARCH_URL = "https://api.yelp.com/v3/businesses/search"
+# Request budget shared by all fetch threads
+YELP_QPS = float(os.getenv('YELP_QPS', '5'))
+YELP_DAILY_QUOTA = int(os.getenv('YELP_DAILY_QUOTA', '500'))
+DEFAULT_WORKERS = 4
+MAX_RETRIES = 5
+PAGE_SIZE = 50
+MAX_OFFSET = 200
+WRITER_THREADS = 2
+# --tiles: Manhattan's bounding box (south, west, north, east) split into a grid.
+# A tile whose search reports more than MAX_OFFSET results is split into four,
+# down to MIN_TILE_DEGREES (about 500 m).
+MANHATTAN_BOUNDS = (40.6990, -74.0200, 40.8820, -73.9070)
+TILE_ROWS = 4
+TILE_COLS = 2
+MIN_TILE_DEGREES = 0.005
+# Checkpoint and dedupe state for --resume
+STATE_DIR = os.getenv('SCRAPE_STATE_DIR', '.scrape_state')
+# Raw search responses, reused for this long before Yelp is asked again
+CACHE_DIR = os.getenv('YELP_CACHE_DIR', '.yelp_cache')
+CACHE_MAX_AGE_HOURS = float(os.getenv('YELP_CACHE_MAX_AGE_HOURS', '168'))
 
 dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
 table = dynamodb.Table('yelp-restaurants')
@@ -17,18 +45,289 @@ CUISINES = ['Chinese', 'Italian', 'Japanese', 'Mexican', 'Indian', 'Thai', 'Amer
 # Tracks business IDs to avoid duplicates across cuisines.
 seen_ids = set()
 
-def search_restaurants(cuisine, location='Manhattan, NY', limit=50, offset=0):
+class QuotaExhausted(Exception):
+    pass
+
+class TokenBucket:
+    # Hands out at most `rate` requests per second (bursts up to `capacity`) and
+    # no more than `quota` in total. On a 429 every thread pauses and the rate
+    # is halved; it creeps back up with each successful request.
+    def __init__(self, rate, capacity, quota):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.quota = quota
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        while True:
+            with self.lock:
+                if self.quota <= 0:
+                    raise QuotaExhausted("Yelp daily quota used up")
+                now = time.monotonic()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.quota -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+    
+    def throttled(self, retry_after):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            self.updated = self.paused_until
+            self.tokens = 0
+            self.rate = max(self.rate / 2, 0.5)
+    
+    def succeeded(self, remaining=None):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 0.1)
+            # Yelp reports what is actually left of the daily quota
+            if remaining is not None:
+                self.quota = min(self.quota, remaining)
+
+bucket = TokenBucket(YELP_QPS, max(YELP_QPS, 1), YELP_DAILY_QUOTA)
+
+session = requests.Session()
+session.headers.update(YELP_HEADERS)
+
+def search_restaurants(cuisine, location='Manhattan, NY', limit=PAGE_SIZE, offset=0, tile=None):
     params = {
         'term': f'{cuisine} restaurants',
-        'location': location,
         'limit': limit,
         'offset': offset,
         'categories': 'restaurants'
     }
-    response = requests.get(YELP_SEARCH_URL, headers=YELP_HEADERS, params=params)
-    return response.json().get('businesses', [])
+    if tile:
+        params.update(tile_circle(tile))
+    else:
+        params['location'] = location
+    data = response_cache.get(params)
+    if data is not None:
+        return data.get('businesses', []), data.get('total', 0)
+    for attempt in range(MAX_RETRIES + 1):
+        bucket.acquire()
+        response = session.get(YELP_SEARCH_URL, params=params, timeout=30)
+        if response.status_code == 429:
+            retry_after = float(response.headers.get('Retry-After', 2 ** attempt))
+            print(f"  Rate limited on {unit_key(cuisine, tile)} offset {offset}, backing off {retry_after}s")
+            bucket.throttled(retry_after)
+            continue
+        response.raise_for_status()
+        remaining = response.headers.get('RateLimit-Remaining')
+        bucket.succeeded(int(remaining) if remaining else None)
+        data = response.json()
+        response_cache.put(params, cuisine, data)
+        return data.get('businesses', []), data.get('total', 0)
+    raise RuntimeError(f"Still rate limited after {MAX_RETRIES} retries: {unit_key(cuisine, tile)} offset {offset}")
+
+# Queue marker asking a writer thread to send everything it has buffered
+FLUSH = object()
+
+def initial_tiles():
+    south, west, north, east = MANHATTAN_BOUNDS
+    height = (north - south) / TILE_ROWS
+    width = (east - west) / TILE_COLS
+    return [
+        (round(south + r * height, 4), round(west + c * width, 4),
+         round(south + (r + 1) * height, 4), round(west + (c + 1) * width, 4))
+        for r in range(TILE_ROWS) for c in range(TILE_COLS)
+    ]
+
+def split_tile(tile):
+    south, west, north, east = tile
+    if north - south < 2 * MIN_TILE_DEGREES:
+        return None
+    mid_lat = round((south + north) / 2, 4)
+    mid_lon = round((west + east) / 2, 4)
+    return [(south, west, mid_lat, mid_lon), (south, mid_lon, mid_lat, east),
+            (mid_lat, west, north, mid_lon), (mid_lat, mid_lon, north, east)]
+
+def tile_circle(tile):
+    # Yelp searches a circle, so use the one through the tile's corners
+    south, west, north, east = tile
+    lat = (south + north) / 2
+    height_m = (north - south) * 111320
+    width_m = (east - west) * 111320 * math.cos(math.radians(lat))
+    return {
+        'latitude': round(lat, 6),
+        'longitude': round((west + east) / 2, 6),
+        'radius': min(40000, math.ceil(math.hypot(height_m, width_m) / 2))
+    }
+
+def unit_key(cuisine, tile):
+    # Checkpoint key for one search: a cuisine, or a cuisine within a tile
+    if tile is None:
+        return cuisine
+    return f"{cuisine}@{','.join(str(x) for x in tile)}"
+
+class ResponseCache:
+    # Every businesses/search response, gzipped JSON under a SHA-256 of its
+    # request parameters (fanned out by the first two hex digits). Entries
+    # keep the parameters and the cuisine so --offline can rebuild items
+    # without knowing how the crawl was laid out.
+    def __init__(self, cache_dir=CACHE_DIR, max_age_hours=CACHE_MAX_AGE_HOURS):
+        self.dir = cache_dir
+        self.max_age = max_age_hours * 3600
+        self.hits = 0
+        self.misses = 0
+    
+    def path(self, params):
+        digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.dir, digest[:2], digest + '.json.gz')
+    
+    def get(self, params):
+        path = self.path(params)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                self.misses += 1
+                return None
+            with gzip.open(path, 'rt') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry['response']
+    
+    def put(self, params, cuisine, response):
+        path = self.path(params)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {'params': params, 'cuisine': cuisine, 'fetchedAt': datetime.now().isoformat(), 'response': response}
+        # Written under a per-thread temp name and renamed, so readers never see half a file
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp, 'wt') as f:
+            json.dump(entry, f)
+        os.replace(tmp, path)
+    
+    def entries(self):
+        # Every cached response regardless of age, in a stable order
+        for root, _, files in sorted(os.walk(self.dir)):
+            for name in sorted(files):
+                if name.endswith('.json.gz'):
+                    with gzip.open(os.path.join(root, name), 'rt') as f:
+                        yield json.load(f)
 
-def save_restaurant(business, cuisine):
+response_cache = ResponseCache()
+
+class RestaurantWriter:
+    # Spreads items round-robin over a few threads, each writing through its own
+    # Table.batch_writer(): up to 25 items per BatchWriteItem call, with repeats
+    # of a BusinessID inside one batch collapsed. BatchWriter resends unprocessed
+    # items itself; an after-call hook counts calls and those resends.
+    def __init__(self, threads=WRITER_THREADS):
+        self.queues = [queue.Queue(maxsize=1000) for _ in range(threads)]
+        self.next = 0
+        self.calls = 0
+        self.unprocessed = 0
+        self.error = None
+        self.lock = threading.Lock()
+        table.meta.client.meta.events.register('after-call.dynamodb.BatchWriteItem', self.count_call)
+        self.threads = [threading.Thread(target=self.run, args=(items,), daemon=True) for items in self.queues]
+        for thread in self.threads:
+            thread.start()
+    
+    def count_call(self, parsed, **kwargs):
+        with self.lock:
+            self.calls += 1
+            self.unprocessed += sum(len(items) for items in (parsed.get('UnprocessedItems') or {}).values())
+    
+    def put(self, item):
+        if self.error:
+            raise self.error
+        self.queues[self.next].put(item)
+        self.next = (self.next + 1) % len(self.queues)
+    
+    def run(self, items):
+        # Queue entries are only marked done once the batch writer holding them
+        # has been flushed, so flush() returning means they are in DynamoDB
+        taken = 0
+        item = FLUSH
+        try:
+            while True:
+                with table.batch_writer(overwrite_by_pkeys=['BusinessID']) as batch:
+                    item = items.get()
+                    taken += 1
+                    while item is not None and item is not FLUSH:
+                        batch.put_item(Item=item)
+                        item = items.get()
+                        taken += 1
+                for _ in range(taken):
+                    items.task_done()
+                taken = 0
+                if item is None:
+                    return
+        except Exception as e:
+            self.error = e
+            for _ in range(taken):
+                items.task_done()
+            # The batch that failed already took close()'s None, so nothing more will come
+            if item is None:
+                return
+            # Keep draining so the crawl doesn't block on a full queue or a flush
+            while True:
+                item = items.get()
+                items.task_done()
+                if item is None:
+                    return
+    
+    def flush(self):
+        for items in self.queues:
+            items.put(FLUSH)
+        for items in self.queues:
+            items.join()
+        if self.error:
+            raise self.error
+    
+    def close(self):
+        for items in self.queues:
+            items.put(None)
+        for thread in self.threads:
+            thread.join()
+        print(f"BatchWriteItem calls: {self.calls}, unprocessed items resent: {self.unprocessed}")
+        if self.error:
+            raise self.error
+
+class Checkpoint:
+    # Which pages are done (and each cuisine's total) plus every BusinessID seen
+    # so far, saved after each page. The IDs go to a sorted text file, one per
+    # line. Both files are replaced atomically, so a crash leaves the last good copy.
+    def __init__(self, state_dir=STATE_DIR):
+        self.path = os.path.join(state_dir, 'checkpoint.json')
+        self.ids_path = os.path.join(state_dir, 'seen_ids.txt')
+        self.done = set()
+        self.totals = {}
+        os.makedirs(state_dir, exist_ok=True)
+    
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            self.done = {tuple(page) for page in state['done']}
+            self.totals = state['totals']
+        if os.path.exists(self.ids_path):
+            with open(self.ids_path) as f:
+                seen_ids.update(line.strip() for line in f if line.strip())
+        print(f"Resuming: {len(self.done)} pages done, {len(seen_ids)} restaurants seen")
+    
+    def save(self):
+        self.write(self.ids_path, ''.join(f"{business_id}\n" for business_id in sorted(seen_ids)))
+        self.write(self.path, json.dumps({'done': sorted(self.done), 'totals': self.totals}))
+    
+    def write(self, path, text):
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(path + '.tmp', path)
+
+def save_restaurant(business, cuisine, writer):
     if business['id'] in seen_ids:
         return False
     seen_ids.add(business['id'])
@@ -52,24 +351,136 @@ def save_restaurant(business, cuisine):
         'insertedAtTimestamp': datetime.now().isoformat()
     }
     
-    table.put_item(Item=item)
+    writer.put(item)
     return True
 
-def scrape_all():
-    for cuisine in CUISINES:
-        print(f"\nScraping {cuisine} restaurants...")
-        count = 0
-        for offset in range(0, 200, 50):
-            businesses = search_restaurants(cuisine, offset=offset)
-            if not businesses:
-                break
-            for b in businesses:
-                if save_restaurant(b, cuisine):
-                    count += 1
-            time.sleep(0.5)  # Rate limiting
+def scrape_all(workers=DEFAULT_WORKERS, resume=False, tiles=False):
+    # Pages are fetched concurrently; the token bucket, not network latency,
+    # decides how fast the crawl goes. Items are handed to the batch writers.
+    counts = {cuisine: 0 for cuisine in CUISINES}
+    coverage = {}
+    session.mount('https://', HTTPAdapter(pool_maxsize=workers))
+    writer = RestaurantWriter()
+    checkpoint = Checkpoint()
+    if resume:
+        checkpoint.load()
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pages = {}
+        out_of_quota = False
+        
+        def submit(cuisine, tile, offset):
+            if not out_of_quota and (unit_key(cuisine, tile), offset) not in checkpoint.done:
+                future = executor.submit(search_restaurants, cuisine, offset=offset, tile=tile)
+                pages[future] = (cuisine, tile, offset)
+        
+        def start(cuisine, tile):
+            # The first page of a search tells how many results it has: split
+            # the tile if Yelp can't page through all of them, else page the rest
+            total = checkpoint.totals.get(unit_key(cuisine, tile))
+            if total is None:
+                submit(cuisine, tile, 0)
+            elif tile and total > MAX_OFFSET and split_tile(tile):
+                coverage.setdefault(unit_key(cuisine, tile), {'total': total, 'fetched': 0, 'new': 0})['split'] = True
+                for child in split_tile(tile):
+                    start(cuisine, child)
+            else:
+                for offset in range(PAGE_SIZE, min(total, MAX_OFFSET), PAGE_SIZE):
+                    submit(cuisine, tile, offset)
+        
+        for cuisine in CUISINES:
+            for tile in (initial_tiles() if tiles else [None]):
+                start(cuisine, tile)
+        
+        while pages:
+            done, _ = wait(pages, return_when=FIRST_COMPLETED)
+            for future in done:
+                cuisine, tile, offset = pages.pop(future)
+                if future.cancelled():
+                    continue
+                try:
+                    businesses, total = future.result()
+                except QuotaExhausted as e:
+                    if not out_of_quota:
+                        print(f"  {e}, stopping; rerun with --resume to continue")
+                        out_of_quota = True
+                    for pending in pages:
+                        pending.cancel()
+                    continue
+                except Exception as e:
+                    print(f"  Error fetching {unit_key(cuisine, tile)} offset {offset}: {e}")
+                    continue
+                
+                key = unit_key(cuisine, tile)
+                stats = coverage.setdefault(key, {'total': total, 'fetched': 0, 'new': 0})
+                stats['fetched'] += len(businesses)
+                for b in businesses:
+                    if save_restaurant(b, cuisine, writer):
+                        counts[cuisine] += 1
+                        stats['new'] += 1
+                
+                # Only checkpoint once the page's items are written
+                writer.flush()
+                checkpoint.done.add((key, offset))
+                if offset == 0:
+                    checkpoint.totals[key] = total
+                    start(cuisine, tile)
+                checkpoint.save()
+    
+    writer.close()
+    if tiles:
+        print("\nCoverage per tile:")
+        for key, stats in sorted(coverage.items()):
+            if stats.get('split'):
+                note = "split"
+            elif stats['total'] > MAX_OFFSET:
+                note = f"capped at {MAX_OFFSET}"
+            else:
+                note = "complete"
+            print(f"  {key}: {stats['total']} results, fetched {stats['fetched']}, {stats['new']} new ({note})")
+    print(f"Response cache: {response_cache.hits} hits, {response_cache.misses} misses")
+    for cuisine, count in counts.items():
         print(f"  Saved {count} {cuisine} restaurants")
+    print(f"\nTotal unique restaurants: {len(seen_ids)}")
+
+def rebuild_offline():
+    # Rewrites DynamoDB from the response cache alone: no Yelp requests, no
+    # quota, no checkpoint. Cuisines go in CUISINES order so a restaurant found
+    # under several keeps the same one as in a fresh crawl's dedupe.
+    order = {cuisine: i for i, cuisine in enumerate(CUISINES)}
+    entries = sorted(response_cache.entries(), key=lambda entry: order.get(entry['cuisine'], len(order)))
+    if not entries:
+        print(f"No cached responses in {response_cache.dir}")
+        return
+    
+    counts = {}
+    writer = RestaurantWriter()
+    for entry in entries:
+        cuisine = entry['cuisine']
+        counts.setdefault(cuisine, 0)
+        for b in entry['response'].get('businesses', []):
+            if save_restaurant(b, cuisine, writer):
+                counts[cuisine] += 1
+    writer.close()
     
+    print(f"Rebuilt from {len(entries)} cached responses")
+    for cuisine, count in counts.items():
+        print(f"  Saved {count} {cuisine} restaurants")
     print(f"\nTotal unique restaurants: {len(seen_ids)}")
 
 if __name__ == '__main__':
-    scrape_all()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Scrape Yelp restaurants into DynamoDB")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help="concurrent Yelp requests in flight (rate is capped by YELP_QPS)")
+    parser.add_argument('--resume', action='store_true',
+                        help=f"continue from the checkpoint in {STATE_DIR} instead of starting over")
+    parser.add_argument('--tiles', action='store_true',
+                        help="search a lat/lon grid over Manhattan, splitting tiles that hit Yelp's result cap")
+    parser.add_argument('--offline', action='store_true',
+                        help=f"rebuild DynamoDB items from the responses cached in {CACHE_DIR} without calling Yelp")
+    args = parser.parse_args()
+    
+    if args.offline:
+        rebuild_offline()
+    else:
+        scrape_all(args.workers, args.resume, args.tiles)
\ No newline at end of file